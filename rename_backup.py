@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
 #######################################################################################################################
-# Utility for renaming plurality of backups in ./backups directory from --rename-from to --rename-to
+# Utility for renaming plurality of backups in ./backups directory from --rename-from to --rename-to, or in bulk from a
+# mapping file, and for converting zipped backups to .tar.zst archives
 #######################################################################################################################
 
 import typer
@@ -25,6 +26,10 @@ import keyring
 import sys
 import io
 import smtplib
+import socket
+import concurrent.futures
+import multiprocessing
+import sg_backup
 
 
 app = typer.Typer()
@@ -32,6 +37,10 @@ app = typer.Typer()
 
 TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 
+# Progress of a batch run is written ahead to this file in the backups directory, so an interrupted run picks up where
+# it left off (and updates trackers for work already done) when rerun
+CHECKPOINT_FILE_NAME = 'rename_backup_checkpoint.json'
+
 # Intervals are slightly less than stated backup interval to allow for jitter of cron kickoff timing.
 # These are 'Live' backup intervals below.  Comment these out and use artificially short test intervals below
 # in test mode.
@@ -76,11 +85,28 @@ class g:
 
 @app.command()
 def process(
-        rename_from: Annotated[str, typer.Option("--rename-from", help="Date stamp (YYYYMMDDHHMMSS) of " \
-            "current backup to be renamed.")],
-        rename_to: Annotated[str, typer.Option("--rename-to", help="Date stamp (YYYYMMDDHHMMSS) to " \
+        rename_from: Annotated[Optional[str], typer.Option("--rename-from", help="Date stamp (YYYYMMDDHHMMSS) of " \
+            "current backup to be renamed.")] = None,
+        rename_to: Annotated[Optional[str], typer.Option("--rename-to", help="Date stamp (YYYYMMDDHHMMSS) to " \
             "rename to.  Often this is an earlier date stamp than --rename from in order to trigger interval " \
-            "updates.")],
+            "updates.")] = None,
+        mapping_file: Annotated[Optional[Path], typer.Option("--mapping-file", exists=True, file_okay=True,
+            dir_okay=False, readable=True, resolve_path=True, help="File with one '<from> <to>' pair of backup " \
+            "names per line (blank lines and lines starting with # are ignored) to apply to all sites in one run.  " \
+            "Names are date stamps (YYYYMMDDHHMMSS) with optional .zip or .tar.zst ending.  A <to> with a " \
+            "different date stamp renames the backup, and a <to> ending in .tar.zst for a .zip backup converts it.  " \
+            "If <to> has no ending, the backup keeps its format.")] = None,
+        convert_zips: Annotated[bool, typer.Option("--convert-zips", help="Convert every zipped backup to a " \
+            ".tar.zst archive (the format sg_backup.py --recompress uses for long-lived backups).  Requires " \
+            "zstd.")] = False,
+        site: Annotated[Optional[List[str]], typer.Option("--site", help="Only work on this site (can be " \
+            "specified multiple times).  Defaults to all sites with a backup schedule.")] = None,
+        workers: Annotated[int, typer.Option("--workers", help="Number of backups converted at once, each in its " \
+            "own process.")] = max(1, (os.cpu_count() or 2) // sg_backup.RECOMPRESS_ZSTD_THREADS),
+        dry_run: Annotated[bool, typer.Option("--dry-run", help="Print what would be renamed and converted, and " \
+            "exit.")] = False,
+        node_name: Annotated[Optional[str], typer.Option("--node-name", help="Name of this node in site lease " \
+            "files (see sg_backup.py --node-name).  Defaults to the host name.")] = None,
         vault_file: Annotated[Optional[Path], typer.Option("--vault-file", exists=True, file_okay=True, dir_okay=False,
             readable=True, resolve_path=True, help="Credentials and settings vault file which is an encrypted " \
             "ansible vault file. If not specified, defaults to ./vault.yml file in the same directory as this " \
@@ -106,8 +132,10 @@ def process(
     g.datetime_start = datetime.datetime.now()
     g.datetime_start_string = g.datetime_start.strftime(TIMESTAMP_FORMAT)
 
-    # Grab directory path to backups
+    # Grab directory path to backups, and share it (and this node's name for leases) with sg_backup functions used here
     g.backups_dir_path = os.path.dirname(os.path.abspath(__file__)) + '/backups'
+    sg_backup.g.backups_dir_path = g.backups_dir_path
+    sg_backup.g.node_name = node_name or socket.gethostname()
 
     # Set up base logging
     root_logger = logging.getLogger() # Grab root logger
@@ -135,36 +163,38 @@ def process(
     # Create a hook to funnel all unhandled exceptions into errors
     sys.excepthook = except_hook
 
-    # Test rename_from and rename_to
-    try:
-        stripped = strip_zip(rename_from)
-        assert(len(stripped) == 14)
-        x = datetime.datetime.strptime(stripped, TIMESTAMP_FORMAT)
-    except:
-        logging.error(f"--rename-from argument '{rename_from} must be in YYYYMMDDHHMMSS format with optional " \
-            '.zip ending.')
+    # Collect requested renames and conversions as (from, to) pairs of backup names
+    mappings = []
+    if rename_from is not None or rename_to is not None:
+        if rename_from is None or rename_to is None:
+            logging.error('--rename-from and --rename-to must be specified together.')
+            exit(1)
+        mappings.append((rename_from, rename_to))
+    if mapping_file:
+        with open(mapping_file) as mapping_file_handle:
+            for line_number, line in enumerate(mapping_file_handle, 1):
+                if not line.strip() or line.strip().startswith('#'):
+                    continue
+                if len(line.split()) != 2:
+                    logging.error(f"Line {line_number} of {mapping_file} must be '<from> <to>': {line.strip()}")
+                    exit(1)
+                mappings.append(tuple(line.split()))
+    if not mappings and not convert_zips:
+        logging.error('Nothing to do.  Specify --rename-from and --rename-to, --mapping-file or --convert-zips.')
         exit(1)
-    try:
-        stripped = strip_zip(rename_to)
-        assert(len(stripped) == 14)
-        x = datetime.datetime.strptime(stripped, TIMESTAMP_FORMAT)
-    except:
-        logging.error(f"--rename-to argument '{rename_to} must be in YYYYMMDDHHMMSS format with optional " \
-            '.zip ending.')
+    for mapping in mappings:
+        for backup_name in mapping:
+            try:
+                split_backup_name(backup_name)
+            except:
+                logging.error(f"Backup name '{backup_name}' must be in YYYYMMDDHHMMSS format with optional .zip or " \
+                    '.tar.zst ending.')
+                exit(1)
+    if (convert_zips or any(x[1].endswith(sg_backup.TAR_ZST_EXTENSION) for x in mappings)) and \
+       shutil.which('zstd') is None:
+        logging.error('Converting backups to .tar.zst archives requires zstd, which was not found.')
         exit(1)
 
-    # Ensure if rename_from ends in '.zip' that rename_to also ends in '.zip'
-    if len(rename_from) > 4 and rename_from[-4:] == '.zip':
-        if len(rename_to) < 5 or rename_to[-4:] != '.zip':
-            logging.error(f"If --rename-from argument '{rename_from}' ends in '.zip' then --rename-to argument " \
-                f"'{rename_to}' must also end in '.zip'.")
-            exit(1)
-    elif len(rename_to) > 4 and rename_to[-4:] == '.zip':
-        if len(rename_from) < 5 or rename_from[-4:] != '.zip':
-            logging.error(f"If --rename-to argument '{rename_to}' ends in '.zip' then --rename-from argument " \
-                f"'{rename_from}' must also end in '.zip'.")
-            exit(1)
-
     # Open vault file with credentials and settings
     program_path = os.path.dirname(os.path.abspath(__file__))
     if vault_file:
@@ -187,73 +217,192 @@ def process(
     vault = Vault(vault_password)
     vault_data = vault.load(open(vault_file_path).read())
     sites_data = vault_data['sites']
-
-    for site_name in sites_data:
-        if 'backup_intervals' not in sites_data[site_name]:
-            continue
-        existing_backups = get_existing_backups(site_name)
-        backups_tracker_current = get_current_backups_tracker(site_name)
+    site_names = [ x for x in sites_data if 'backup_intervals' in sites_data[x] and (not site or x in site) ]
+
+    # Plan all work up front (so a bad mapping fails before anything changes), folding in unfinished work of an
+    # interrupted earlier run
+    checkpoint = get_checkpoint()
+    plan = {}
+    for site_name in site_names:
+        site_plan = plan_site(site_name, mappings, convert_zips)
+        for (from_name, to_name) in checkpoint.get(site_name, {}).items():
+            if not is_migrated(site_name, from_name, to_name):
+                site_plan[from_name] = to_name
+        if site_plan or checkpoint.get(site_name):
+            plan[site_name] = site_plan
+    for site_name in plan:
         print(f'Site: {site_name}')
-        for existing_backup in existing_backups:
-            if existing_backup[1] == rename_from:
-                os.rename(f'{g.backups_dir_path}/{site_name}/{existing_backup[1]}',
-                    f'{g.backups_dir_path}/{site_name}/{rename_to}')
-                logging.info(f"Renamed '{g.backups_dir_path}/{site_name}/{existing_backup[1]}' " \
-                    f"'{g.backups_dir_path}/" f"{site_name}/{rename_to}'")
-                for backup_interval in backups_tracker_current:
-                    for backup in backups_tracker_current[backup_interval]:
-                        if backup == rename_from:
-                            logging.info(f"Renaming '{backup_interval}' interval '{rename_from}' to '{rename_to}' " \
-                                "in JSON tracker")
-                            backups_tracker_current[backup_interval].remove(rename_from)
-                            backups_tracker_current[backup_interval].append(rename_to)
-        json.dump(backups_tracker_current, open(g.backups_dir_path + '/' + site_name + '/backups_tracker.json', 'w'))
-        logging.info(f"Rewrote '{g.backups_dir_path}/{site_name}/backups_tracker.json' file")
-    print('Done!')
-
-
-def get_existing_backups(site_name):
-    global g
-
-    backup_path = g.backups_dir_path + '/' + site_name
-    if not os.path.isdir(backup_path):
-        return []
-
-    backups_for_site = {}
-    for subfolder in [ f.path for f in os.scandir(backup_path) if f.is_dir() or ( f.is_file() and \
-        is_zip_file(f.path) ) ]:
-        subfolder_leaf = os.path.basename(subfolder)
-        subfolder_leaf_wo_ext = pathlib.Path(subfolder_leaf).stem
-        try:
-            backup_datetime = datetime.datetime.strptime(subfolder_leaf_wo_ext, TIMESTAMP_FORMAT)
-        except:
-            logging.warning(f'Found subfolder in {backup_path} without proper YYYYmmddHHMMSS ' \
-                                        f'format: {subfolder_leaf}. Ignoring.')
-            continue
-        backups_for_site[backup_datetime] = subfolder_leaf
-    return [ ( x, backups_for_site[x] ) for x in sorted(backups_for_site) ]
+        for from_name in sorted(plan[site_name]):
+            print(f'    {from_name} -> {plan[site_name][from_name]}')
+    if dry_run:
+        exit(0)
 
+    # Claim each site to be changed so sg_backup.py runs (on any node) leave it alone meanwhile
+    leases = {}
+    try:
+        for site_name in list(plan):
+            leases[site_name] = sg_backup.Lease(site_name, 'site')
+            if not leases[site_name].acquire(heartbeat=True):
+                logging.warning(f'Skipping site {site_name} since another node holds its lease')
+                del plan[site_name]
+                del leases[site_name]
+                continue
+            sg_backup.g.site_leases[site_name] = leases[site_name]
+
+        # Record all planned work before starting it, then migrate backups of all sites in one process pool
+        for site_name in plan:
+            checkpoint.setdefault(site_name, {}).update(plan[site_name])
+        save_checkpoint(checkpoint)
+        errors = []
+        # Workers are spawned rather than forked, since the lease heartbeat threads are already running
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                initargs=(g.backups_dir_path, logging_level_numeric),
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = { executor.submit(migrate_backup, site_name, from_name, to_name): (site_name, from_name)
+                        for site_name in plan for (from_name, to_name) in plan[site_name].items() }
+            for future in concurrent.futures.as_completed(futures):
+                (site_name, from_name) = futures[future]
+                try:
+                    future.result()
+                    logging.info(f"Migrated '{g.backups_dir_path}/{site_name}/{from_name}' to " \
+                        f"'{g.backups_dir_path}/{site_name}/{plan[site_name][from_name]}'")
+                except Exception as e:
+                    errors.append(f'{site_name}/{from_name}: {e}')
+
+        # Rewrite each changed site's tracker (and db_store index) once, for the backups that were migrated
+        for site_name in plan:
+            migrated = { x: y for (x, y) in checkpoint[site_name].items() if is_migrated(site_name, x, y) }
+            if migrated:
+                update_site_records(site_name, migrated)
+            for from_name in migrated:
+                del checkpoint[site_name][from_name]
+            if not checkpoint[site_name]:
+                del checkpoint[site_name]
+            save_checkpoint(checkpoint)
+    finally:
+        for lease in leases.values():
+            lease.release()
+
+    if errors:
+        err_string = f'Migrating backups failed for: {"; ".join(errors)}.  Rerun to retry.'
+        logging.error(err_string)
+        raise Exception(err_string)
+    print('Done!')
 
-def is_zip_file(file_name):
-    return os.path.splitext(file_name)[1] == '.zip'
 
+# Splits a backup name into date stamp and ending ('', '.zip' or '.tar.zst'), raising on a malformed name
+def split_backup_name(backup_name):
+    backup_stamp = sg_backup.strip_archive(backup_name)
+    assert(len(backup_stamp) == 14)
+    datetime.datetime.strptime(backup_stamp, TIMESTAMP_FORMAT)
+    return (backup_stamp, backup_name[len(backup_stamp):])
 
-def strip_zip(file_name):
-    if len(file_name) > 4:
-        if file_name[-4:] == '.zip':
-            return file_name[:-4]
-    return file_name
 
+# Returns {from: to} backup names of a site for the given mappings and --convert-zips rule.  Mappings that do not match
+# a backup of the site are ignored, while mappings that cannot be applied raise.
+def plan_site(site_name, mappings, convert_zips):
+    existing_backups = { sg_backup.strip_archive(x[1]): x[1] for x in sg_backup.get_existing_backups(site_name) }
+    site_plan = {}
+    for (from_name, to_name) in mappings:
+        (from_stamp, from_ending) = split_backup_name(from_name)
+        (to_stamp, to_ending) = split_backup_name(to_name)
+        if from_stamp not in existing_backups or (from_ending and existing_backups[from_stamp] != from_name):
+            continue
+        from_name = existing_backups[from_stamp]
+        from_ending = split_backup_name(from_name)[1]
+        to_ending = to_ending or from_ending
+        if convert_zips and to_ending == '.zip':
+            to_ending = sg_backup.TAR_ZST_EXTENSION
+        if to_ending != from_ending and (from_ending, to_ending) != ('.zip', sg_backup.TAR_ZST_EXTENSION):
+            err_string = f"Cannot change {from_name} of site {site_name} into {to_stamp + to_ending}.  Only .zip " \
+                "backups can be converted (to .tar.zst)."
+            logging.error(err_string)
+            raise Exception(err_string)
+        site_plan[from_name] = to_stamp + to_ending
+    if convert_zips:
+        for backup_name in existing_backups.values():
+            if sg_backup.is_zip_file(backup_name) and backup_name not in site_plan:
+                site_plan[backup_name] = sg_backup.strip_archive(backup_name) + sg_backup.TAR_ZST_EXTENSION
+    site_plan = { x: y for (x, y) in site_plan.items() if x != y }
+
+    # Renamed backups must not collide with each other or with backups that stay
+    target_stamps = [ sg_backup.strip_archive(x) for x in site_plan.values() ]
+    remaining_stamps = set(existing_backups) - { sg_backup.strip_archive(x) for x in site_plan }
+    if len(set(target_stamps)) != len(target_stamps) or remaining_stamps & set(target_stamps):
+        err_string = f'Renames for site {site_name} would give several backups the same date stamp'
+        logging.error(err_string)
+        raise Exception(err_string)
+    return site_plan
+
+
+# Converts (if needed) and renames one backup.  Runs in a worker process, and is safe to rerun after an interruption.
+def migrate_backup(site_name, from_name, to_name):
+    site_path = g.backups_dir_path + '/' + site_name
+    current_name = from_name
+    if sg_backup.is_zip_file(from_name) and to_name.endswith(sg_backup.TAR_ZST_EXTENSION):
+        current_name = sg_backup.strip_archive(from_name) + sg_backup.TAR_ZST_EXTENSION
+        if os.path.exists(site_path + '/' + from_name):
+            sg_backup.recompress_backup(site_name, from_name)
+    if current_name != to_name:
+        os.rename(site_path + '/' + current_name, site_path + '/' + to_name)
+
+
+# True once a backup exists under its new name and nothing is left under its old or intermediate names
+def is_migrated(site_name, from_name, to_name):
+    site_path = g.backups_dir_path + '/' + site_name
+    leftover_names = { from_name, sg_backup.strip_archive(from_name) + sg_backup.TAR_ZST_EXTENSION } - { to_name }
+    return os.path.exists(site_path + '/' + to_name) and \
+        not any(os.path.exists(site_path + '/' + x) for x in leftover_names)
+
+
+# Applies migrated backup names to a site's tracker and db_store index, each in a single atomic rewrite, and then
+# confirms the tracker matches the backups on disk
+def update_site_records(site_name, migrated):
+    backups_tracker_current = sg_backup.get_current_backups_tracker(site_name)
+    for backup_interval in backups_tracker_current:
+        for backup in backups_tracker_current[backup_interval]:
+            if backup in migrated:
+                logging.info(f"Renaming '{backup_interval}' interval '{backup}' to '{migrated[backup]}' in JSON " \
+                    "tracker")
+        backups_tracker_current[backup_interval] = sorted(migrated.get(x, x) for x in
+            backups_tracker_current[backup_interval])
+    sg_backup.save_backups_tracker(site_name, backups_tracker_current)
+    logging.info(f"Rewrote '{g.backups_dir_path}/{site_name}/backups_tracker.json' file")
+
+    stamps = { sg_backup.strip_archive(x): sg_backup.strip_archive(y) for (x, y) in migrated.items() }
+    db_store_index = sg_backup.get_db_store_index(site_name)
+    if stamps.keys() & db_store_index.keys():
+        db_store_index = { stamps.get(x, x): { 'file': y['file'], 'base': stamps.get(y['base'], y['base']) }
+                           for (x, y) in db_store_index.items() }
+        sg_backup.save_db_store_index(site_name, db_store_index)
+        logging.info(f"Rewrote '{g.backups_dir_path}/{site_name}/{sg_backup.DB_STORE_DIR_NAME}/index.json' file")
+    sg_backup.get_current_tracker_and_backups(site_name)
+
+
+def get_checkpoint():
+    checkpoint_filename = g.backups_dir_path + '/' + CHECKPOINT_FILE_NAME
+    if os.path.isfile(checkpoint_filename):
+        with open(checkpoint_filename) as checkpoint_file:
+            return json.load(checkpoint_file)
+    return {}
+
+
+def save_checkpoint(checkpoint):
+    checkpoint_filename = g.backups_dir_path + '/' + CHECKPOINT_FILE_NAME
+    if not checkpoint:
+        if os.path.isfile(checkpoint_filename):
+            os.remove(checkpoint_filename)
+        return
+    json.dump(checkpoint, open(checkpoint_filename + '.tmp', 'w'))
+    os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+
+
+def init_worker(backups_dir_path, logging_level_numeric):
+    g.backups_dir_path = backups_dir_path
+    sg_backup.g.backups_dir_path = backups_dir_path
+    logging.basicConfig(level=logging_level_numeric, format='%(asctime)s %(levelname)s\t%(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
 
-def get_current_backups_tracker(site_name):
-    backups_tracker_filename = g.backups_dir_path + '/' + site_name + '/backups_tracker.json'
-    if os.path.isfile(backups_tracker_filename):
-        with open(backups_tracker_filename) as backups_tracker_file:
-            current_backups_tracker = json.load(backups_tracker_file)
-    else:
-        current_backups_tracker = {}
-    return current_backups_tracker
-    
 
 def except_hook(type,value,traceback):
     logging.error("Unhandled exception occured",exc_info=(type,value,traceback))
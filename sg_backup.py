@@ -15,7 +15,6 @@ from enum import Enum
 import locale
 import logging
 import logging.handlers
-import pathlib
 import json
 from pathlib import Path
 import shutil
@@ -23,8 +22,29 @@ import subprocess
 import getpass
 import keyring
 import sys
-import io
 import smtplib
+import struct
+import hashlib
+import zipfile
+import tarfile
+import zlib
+import stat
+import contextlib
+import time
+import cProfile
+import pstats
+import shlex
+import heapq
+import concurrent.futures
+import collections
+import socket
+import fnmatch
+import tempfile
+import threading
+import uuid
+import signal
+import statistics
+import asyncio
 
 
 app = typer.Typer()
@@ -32,6 +52,83 @@ app = typer.Typer()
 
 TIMESTAMP_FORMAT = '%Y%m%d%H%M%S'
 
+# Bounds on what is captured for the notification email.  Full text of every message is always in messages.log.
+EMAIL_CAPTURE_RECORDS_PER_SITE = 50
+EMAIL_CAPTURE_MESSAGE_LENGTH = 2000
+
+# rsync output is parsed as it streams in rather than buffered.  Progress is logged every RSYNC_PROGRESS_SECONDS and
+# only the last RSYNC_ERROR_TAIL_LINES lines are kept for error reporting.
+RSYNC_PROGRESS_SECONDS = 30
+RSYNC_ERROR_TAIL_LINES = 40
+
+# Output of other external and remote commands is returned to be parsed (du, ls), so more of it is kept, but only the
+# last COMMAND_OUTPUT_MAX_LINES lines so a chatty failing command (e.g. cp or tar on a large site) cannot exhaust memory
+COMMAND_OUTPUT_MAX_LINES = 10000
+RSYNC_PROGRESS_REGEX = re.compile(r'^\s*([\d,]+)\s+(\d+)%\s+(\S+/s)\s+(\d+:\d\d:\d\d)')
+RSYNC_TOTAL_SIZE_REGEX = re.compile(r'^total size is ([\d,]+)')
+
+# A tar stream is used instead of rsync when at least this fraction of files changed in the last backup (and history
+# does not show rsync to be faster).  Transfer history kept per site is capped at TRANSFER_HISTORY_LENGTH backups.
+TAR_CHURN_THRESHOLD = 0.5
+TRANSFER_HISTORY_LENGTH = 20
+
+# Timeouts (in seconds) for SSH tests, so one unreachable host cannot hang a test of all sites
+SSH_CONNECT_TIMEOUT = 10
+SSH_AUTH_TIMEOUT = 15
+SSH_COMMAND_TIMEOUT = 15
+SSH_TEST_MAX_WORKERS = 16
+
+# Remote commands run through the OpenSSH client (the same one rsync uses) time out after these many seconds:
+# housekeeping commands like listing or removing files, and database dumps
+SSH_QUICK_COMMAND_TIMEOUT = 60
+MYSQLDUMP_TIMEOUT = 2 * 60 * 60
+
+# Replication of backups to a secondary target pushes this many archives at once.  Uploads to S3-compatible targets
+# are additionally split into parallel multipart chunks.
+REPLICATION_MAX_WORKERS = 4
+REPLICATION_MULTIPART_CHUNK_SIZE = 64 * 1024 * 1024
+REPLICATION_MULTIPART_CONCURRENCY = 8
+
+# --analyze-transfers looks at changes between this many most recent backups of a site and attributes them to
+# directories up to this many levels below public_html
+ANALYSIS_BACKUPS = 10
+ANALYSIS_DIRECTORY_DEPTH = 3
+
+# When a backup is zipped, its database dump moves to the site's DB_STORE_DIR_NAME directory as a zstd binary delta
+# against a full (keyframe) dump of an earlier backup.  Every delta refers directly to a keyframe, so rebuilding any
+# dump takes at most one decompression and one patch, and a new keyframe starts after DB_DELTA_MAX_DEPENDENTS deltas.
+DB_STORE_DIR_NAME = 'db_store'
+DB_DELTA_MAX_DEPENDENTS = 14
+ZSTD_LONG_ARG = '--long=31'
+
+# Backups are zipped quickly once they are no longer the newest.  Backups kept for RECOMPRESS_TIERS (longest lived
+# first) are later recompressed by --recompress into tar archives compressed with zstd at RECOMPRESS_ZSTD_ARGS.  Up to
+# RECOMPRESS_MAX_WORKERS archives are recompressed at once, each by a zstd niced to RECOMPRESS_NICE using
+# RECOMPRESS_ZSTD_THREADS threads, so the pass stays out of the way of other work on the machine.
+TAR_ZST_EXTENSION = '.tar.zst'
+ARCHIVE_EXTENSIONS = ('.zip', TAR_ZST_EXTENSION)
+RECOMPRESS_TIERS = ('yearly', 'monthly')
+RECOMPRESS_ZSTD_ARGS = '-19 --long=27'
+RECOMPRESS_MAX_WORKERS = 2
+RECOMPRESS_ZSTD_THREADS = 2
+RECOMPRESS_NICE = 19
+
+# Several runner nodes can share one backups directory.  Each site's pipeline runs under a lease file in LEASES_DIR_NAME
+# that its node renews every LEASE_HEARTBEAT_SECONDS, and other nodes may take over a lease not renewed within
+# LEASE_SECONDS.  Tracker updates take a separate short lease so tools working outside the pipeline can update
+# trackers safely too.
+LEASES_DIR_NAME = 'leases'
+LEASE_SECONDS = 300
+LEASE_HEARTBEAT_SECONDS = 60
+
+# Every backup carries a sorted binary manifest of its files so two backups can be compared without unpacking them.
+# The file starts with MANIFEST_MAGIC and each record is the fixed-size MANIFEST_RECORD (size, mtime in nanoseconds,
+# 16-byte BLAKE2b digest, path length) followed by the UTF-8 path relative to the backup directory.  Records are
+# sorted by path bytes, which is what allows diffing in a single streaming merge-join pass.
+MANIFEST_FILE_NAME = 'manifest.bin'
+MANIFEST_MAGIC = b'SGBM\x01'
+MANIFEST_RECORD = struct.Struct('>Qq16sH')
+
 # Intervals are slightly less than stated backup interval to allow for jitter of cron kickoff timing.
 # These are 'Live' backup intervals below.  Comment these out and use artificially short test intervals below
 # in test mode.
@@ -66,12 +163,22 @@ class LoggingLevel(str, Enum):
 class g:
     datetime_now = None
     datetime_stamp = None
-    string_stream = None
+    log_capture = None
     gmail_user = None
     gmail_password = None
     notification_target_email = None
     did_a_backup = None
     ssh_test_failure = None
+    seeding_strategy = None
+    current_site = None
+    profile_dir_path = None
+    profile_spans = None
+    profile_sites = None
+    node_name = None
+    site_leases = {}
+    running_processes = set()
+    running_processes_lock = threading.Lock()
+    deadline = None
 
 
 @app.command()
@@ -104,9 +211,52 @@ def process(
             "site2) or all (default) websites listed in vault.yml are backed up to the --backups_dir target " \
             "directory now independent of specified backup intervals in vault.yml.  In fact, websites without "
             "a backup schedule can only be backed up using this --backup-now flag.")] = False,
-        test_ssh: Annotated[bool, typer.Option("--ssh-test", help="Cycle through all sites in vault.yml and test " \
-            "SSH connectivity to each site.  Specifying subset of sites to test using --backup-site " \
+        test_ssh: Annotated[bool, typer.Option("--ssh-test", help="Test SSH connectivity to all sites in vault.yml " \
+            "concurrently and report connect latency, authentication method, host key status and remote command " \
+            "round trip time for each site.  Specifying subset of sites to test using --backup-site " \
             "parameters is fine.")] = False,
+        ssh_preflight: Annotated[bool, typer.Option("--ssh-preflight", help="Before starting backups, run a " \
+            "command over SSH on all sites at once (with the OpenSSH client used by rsync) and skip (with an error) " \
+            "any site that fails.")] = False,
+        diff: Annotated[List[str], typer.Option("--diff", help="Compare two backups of each site (all sites or " \
+            "those specified with --backup-site) using their manifests and list added (A), deleted (D) and " \
+            "modified (M) files. Specify exactly two backup date stamps (YYYYMMDDHHMMSS with optional .zip or " \
+            ".tar.zst ending), oldest first, e.g. --diff 20240701230000.zip --diff 20240702230000")] = None,
+        replicate_to: Annotated[Optional[str], typer.Option("--replicate-to", help="Replicate backups of each site " \
+            "(all sites or those specified with --backup-site) to a secondary target and exit.  Target is a local " \
+            "directory, ssh://user@host[:port]/path or s3://bucket/prefix (S3-compatible storage such as MinIO, " \
+            "configured in the 'replication' section of vault.yml).  Only zipped backups and stored database dumps " \
+            "are replicated since they no longer change, and a watermark of what has been replicated is kept so " \
+            "each run only pushes new backups and removes deleted ones.")] = None,
+        analyze_transfers: Annotated[bool, typer.Option("--analyze-transfers", help="For each site (all sites or " \
+            "those specified with --backup-site), rank directories by bytes in added or modified files and by " \
+            "number of changed files across recent backups, to show which exclusions in the site's 'filters' " \
+            "setting would save the most time and space, and exit.")] = False,
+        extract_db: Annotated[Optional[str], typer.Option("--extract-db", help="Rebuild the database dump of the " \
+            "backup with the given date stamp (YYYYMMDDHHMMSS with optional .zip or .tar.zst ending) for each " \
+            "site (all sites or those specified with --backup-site) from the site's db_store into " \
+            "<site>_<date stamp>_database.sql in the current directory, and exit.")] = None,
+        node_name: Annotated[Optional[str], typer.Option("--node-name", help="Name of this runner node when several " \
+            "nodes share one backups directory.  Each node claims sites one at a time using lease files in the " \
+            "leases folder of the backups directory and skips sites another node is working on.  Defaults to the " \
+            "host name.")] = None,
+        lease_status: Annotated[bool, typer.Option("--lease-status", help="Show which node holds the lease of each " \
+            "site and site tracker in the backups directory, and exit.")] = False,
+        deadline: Annotated[Optional[float], typer.Option("--deadline", help="Time budget for this run in minutes. " \
+            "Sites are handled in order of their 'priority' setting in vault.yml (highest first) and then shortest " \
+            "estimated backup time (from past runs).  A due backup that is not expected to finish in the remaining " \
+            "time is deferred to the next run, deletion and compression of old backups are deferred until all due " \
+            "backups are done, and a backup still running at the deadline is cancelled and its partial files " \
+            "removed.")] = None,
+        recompress: Annotated[bool, typer.Option("--recompress", help="Recompress zipped backups kept for the " \
+            "monthly or yearly interval of each site (all sites or those specified with --backup-site) into " \
+            "much smaller .tar.zst archives, report space reclaimed per interval, and exit.  Meant for a cron entry " \
+            "at an idle time (runs niced, and honors --deadline by not starting new archives after it).  Requires " \
+            "zstd.")] = False,
+        profile: Annotated[bool, typer.Option("--profile", help="Profile the run.  Each site's backup pipeline " \
+            "runs under cProfile and wall time of subprocess and SSH calls is timed separately.  Per-site " \
+            "<site>.prof files (usable with pstats, snakeviz or flameprof) and a merged summary.txt are written " \
+            "under profiles/<date stamp> in the backups directory.")] = False,
         logging_level: Annotated[
             LoggingLevel, typer.Option(case_sensitive=False)
             ] = LoggingLevel.warning.value):
@@ -128,6 +278,7 @@ def process(
     # Set up base logging
     root_logger = logging.getLogger() # Grab root logger
     root_logger.setLevel(logging.NOTSET) # Ensure EVERYTHING is logged thru root logger (don't block anything there)
+    logging.getLogger('asyncio').setLevel(logging.WARNING) # Event loop setup chatter is of no interest
     logging_formatter = logging.Formatter('%(asctime)s %(levelname)s\t%(message)s', '%Y-%m-%d %H:%M:%S')
 
     # Echo messages to console (stdout)
@@ -137,13 +288,12 @@ def process(
     console_handler.setLevel(logging_level_numeric)
     root_logger.addHandler(console_handler)
 
-    # Gather up ERROR messages into a string to email to someone
-    g.string_stream = io.StringIO()
-    string_handler = logging.StreamHandler(g.string_stream)
-    string_handler.setFormatter(logging_formatter)
-    string_handler.setLevel(logging.NOTSET)
-    string_handler.addFilter(EmailFilter())
-    root_logger.addHandler(string_handler)
+    # Gather up ERROR messages (bounded per site) to email to someone
+    g.log_capture = EmailCaptureHandler()
+    g.log_capture.setFormatter(logging_formatter)
+    g.log_capture.setLevel(logging.NOTSET)
+    g.log_capture.addFilter(EmailFilter())
+    root_logger.addHandler(g.log_capture)
 
     # Create a hook to funnel all unhandled exceptions into errors
     sys.excepthook = except_hook
@@ -174,6 +324,17 @@ def process(
     file_handler.setFormatter(logging_formatter)
     root_logger.addHandler(file_handler)
 
+    g.node_name = node_name or socket.gethostname()
+    if deadline is not None:
+        g.deadline = time.monotonic() + deadline * 60
+
+    # Set up profiling of this run if requested
+    if profile:
+        g.profile_dir_path = g.backups_dir_path + '/profiles/' + g.datetime_start_string
+        os.makedirs(g.profile_dir_path, exist_ok=True)
+        g.profile_spans = {}
+        g.profile_sites = {}
+
     # Open vault file with credentials and settings
     program_path = os.path.dirname(os.path.abspath(__file__))
     if vault_file:
@@ -193,8 +354,9 @@ def process(
     else:
         vault_password = getpass.getpass('Password for vault.yml: ')
 
-    vault = Vault(vault_password)
-    vault_data = vault.load(open(vault_file_path).read())
+    with timed_span('vault decryption'):
+        vault = Vault(vault_password)
+        vault_data = vault.load(open(vault_file_path).read())
     if not no_email:
         if not 'gmail' in vault_data:
             err_string = f"'gmail' is a required section in {vault_file_path} file"
@@ -231,6 +393,11 @@ def process(
         sites_data[site_name]['do_mysql_backup'] = confirm_keys(vault_file, sites_data, site_name, \
             ['ssh_hostname', 'ssh_username', 'ssh_port', 'mysql_user', 'mysql_password', 'mysql_db'])
 
+    # Show lease owners if user specifies --lease-status
+    if lease_status:
+        print_lease_status()
+        exit(0)
+
     # Do simple SSH establishment to all sites if user specifies --test-ssh
     if test_ssh:
         # Force logging level up to at least INFO level to see results of an SSH test
@@ -240,28 +407,85 @@ def process(
             # with logging INFO
             logging.getLogger("paramiko").setLevel(logging.WARNING)
         g.ssh_test_failure = False
-        for site_name in sites_data:
-            site_data = sites_data[site_name]
-            ssh_test(site_name, site_data)
+        run_ssh_tests(sites_data)
         if g.ssh_test_failure and logging_level_numeric >= getattr(logging, 'INFO'):
             print('SSH failure occurred.  Suggestion:  re-run with --logging-level DEBUG to debug failed ' \
                 'SSH connection(s)')
         exit(0)
 
+    # Compare two backups of each site using their manifests if user specifies --diff
+    if diff:
+        if len(diff) != 2:
+            err_string = f'--diff must be specified exactly twice (older and newer backup), not {len(diff)} times.'
+            logging.error(err_string)
+            raise Exception(err_string)
+        for site_name in sites_data:
+            diff_backups(site_name, diff[0], diff[1])
+        exit(0)
+
+    # Rank directories by churn across recent backups if user specifies --analyze-transfers
+    if analyze_transfers:
+        for site_name in sites_data:
+            analyze_transfers_for_site(site_name, sites_data[site_name])
+        exit(0)
+
+    # Rebuild a database dump kept as a delta in db_store if user specifies --extract-db
+    if extract_db:
+        for site_name in sites_data:
+            extract_db_dump(site_name, extract_db)
+        exit(0)
+
+    # Push new (and remove deleted) backups to a secondary target if user specifies --replicate-to
+    if replicate_to:
+        replication_target = parse_replication_target(replicate_to, vault_data.get('replication', {}))
+        for site_name in sites_data:
+            replicate_site(site_name, replication_target)
+        exit(0)
+
+    # Recompress long-lived backups into .tar.zst archives if user specifies --recompress
+    if recompress:
+        recompress_results = {}
+        for site_name in sites_data:
+            if get_backup_schedule(sites_data[site_name]) is not None:
+                run_site_pipeline(site_name, recompress_site, site_name, recompress_results)
+        print_recompress_report(recompress_results)
+        exit(0)
+
+    # Skip sites that cannot be reached before starting long running backups if user specifies --ssh-preflight
+    if ssh_preflight:
+        preflight_errors = asyncio.run(ssh_preflight_async(sites_data))
+        for site_name in [ x for x in preflight_errors if preflight_errors[x] is not None ]:
+            logging.error(f'Skipping site {site_name} since SSH pre-flight test failed: {preflight_errors[site_name]}')
+            del sites_data[site_name]
+
     # Allow for a triggered --backup-now which backs up all sites independent of backup schedule
-    elif backup_now:
+    if backup_now:
         for site_name in sites_data:
             site_data = sites_data[site_name]
-            do_backup(site_name, site_data)
+            run_site_pipeline(site_name, do_backup, site_name, site_data)
+        write_profile_summary()
 
     # It not a "now" (--backup-now) backup, then do the backups if enough time has transpired that a new backup
     # is required per site backup schedules
     else:
         g.did_a_backup = False
-        for site_name in sites_data:
-            site_data = sites_data[site_name]
-            backup_schedule = get_backup_schedule(site_data)
-            do_backup_if_time(site_name, site_data, backup_schedule)
+        if g.deadline is None:
+            for site_name in sites_data:
+                site_data = sites_data[site_name]
+                backup_schedule = get_backup_schedule(site_data)
+                run_site_pipeline(site_name, do_backup_if_time, site_name, site_data, backup_schedule)
+        else:
+            # With a time budget, do due backups first (most important and quickest sites first) and only then use
+            # whatever time remains to delete and compress old backups
+            site_names = order_sites_by_priority(sites_data)
+            for site_name in site_names:
+                site_data = sites_data[site_name]
+                backup_schedule = get_backup_schedule(site_data)
+                run_site_pipeline(site_name, do_backup_if_time, site_name, site_data, backup_schedule, False)
+            for site_name in site_names:
+                if get_backup_schedule(sites_data[site_name]) is not None:
+                    run_site_pipeline(site_name, do_backup_maintenance, site_name, sites_data[site_name])
+        write_profile_summary()
 
         if not g.did_a_backup:
             exit(0)
@@ -269,26 +493,85 @@ def process(
     du_string = '/usr/bin/du -d 2 -h ' + g.backups_dir_path
     logging.debug(f'Executing: {du_string}')
     try:
-        exec_output = subprocess.check_output(du_string, stderr=subprocess.STDOUT, shell=True). \
-            decode(sys.stdout.encoding)
+        with timed_span('du', is_subprocess=True):
+            # Reported even when a --deadline run overran, so not cancellable
+            exec_output = run_command(du_string, 'du', cancellable=False)
         logging.info(f'Size of backups:\n{exec_output}')
     except subprocess.CalledProcessError as e:
         logging.error('du exited with error status ' + str(e.returncode) + ' and error: ' + e.output)
 
-    error_string = g.string_stream.getvalue()
-    if error_string:
-        send_admin_email(error_string)
+    if g.log_capture.has_records():
+        send_admin_email(g.log_capture.render())
 
 
 class EmailFilter(logging.Filter):
     def filter(self, record):
         if 'Completed backup' in record.msg or 'Size of backups' in record.msg or 'No backups to do' in record.msg \
-           or record.levelname == 'ERROR' or record.levelname == 'CRITICAL':
+           or 'Changes since' in record.msg or 'Seeded files' in record.msg or record.levelname == 'ERROR' \
+           or record.levelname == 'CRITICAL':
             return True
         else:
             return False
 
 
+# Captures log records for the notification email with bounded memory: a ring buffer of the most recent records per
+# site, repeated messages collapsed into one entry with a count, and long messages (e.g. subprocess output) truncated
+class EmailCaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.site_entries = {}
+        self.site_entry_index = {}
+        self.site_level_counts = {}
+        self.site_dropped_counts = {}
+
+    def emit(self, record):
+        try:
+            site_name = g.current_site or '(run)'
+            entries = self.site_entries.setdefault(site_name,
+                collections.deque(maxlen=EMAIL_CAPTURE_RECORDS_PER_SITE))
+            entry_index = self.site_entry_index.setdefault(site_name, {})
+            level_counts = self.site_level_counts.setdefault(site_name, {})
+            level_counts[record.levelname] = level_counts.get(record.levelname, 0) + 1
+
+            entry_key = (record.levelname, record.getMessage()[:EMAIL_CAPTURE_MESSAGE_LENGTH])
+            if entry_key in entry_index:
+                entry_index[entry_key]['count'] += 1
+                return
+            if len(entries) == entries.maxlen:
+                dropped_entry = entries[0]
+                del entry_index[dropped_entry['key']]
+                self.site_dropped_counts[site_name] = self.site_dropped_counts.get(site_name, 0) + \
+                    dropped_entry['count']
+            message = self.format(record)
+            if len(message) > EMAIL_CAPTURE_MESSAGE_LENGTH:
+                message = message[:EMAIL_CAPTURE_MESSAGE_LENGTH] + f'... [truncated ' \
+                    f'{len(message) - EMAIL_CAPTURE_MESSAGE_LENGTH:,} characters, full text in messages.log]'
+            entry = { 'key': entry_key, 'message': message, 'count': 1 }
+            entries.append(entry)
+            entry_index[entry_key] = entry
+        except Exception:
+            self.handleError(record)
+
+    def has_records(self):
+        return len(self.site_entries) > 0
+
+    def render(self):
+        lines = [ f'sg_backup run started {g.datetime_start_string}' ]
+        for site_name in self.site_entries:
+            level_counts = ', '.join(f'{x}: {self.site_level_counts[site_name][x]}' for x in
+                sorted(self.site_level_counts[site_name]))
+            lines.append('')
+            lines.append(f'== {site_name} ({level_counts}) ==')
+            if site_name in self.site_dropped_counts:
+                lines.append(f'({self.site_dropped_counts[site_name]} earlier messages omitted, see messages.log)')
+            for entry in self.site_entries[site_name]:
+                if entry['count'] > 1:
+                    lines.append(f"{entry['message']} [repeated {entry['count']} times]")
+                else:
+                    lines.append(entry['message'])
+        return '\n'.join(lines)
+
+
 def get_backup_schedule(site_data):
     if not 'backup_intervals' in site_data:
         return None
@@ -312,17 +595,18 @@ def get_existing_backups(site_name):
         return []
 
     backups_for_site = {}
-    for subfolder in [ f.path for f in os.scandir(backup_path) if f.is_dir() or ( f.is_file() and \
-        is_zip_file(f.path) ) ]:
-        subfolder_leaf = os.path.basename(subfolder)
-        subfolder_leaf_wo_ext = pathlib.Path(subfolder_leaf).stem
-        try:
-            backup_datetime = datetime.datetime.strptime(subfolder_leaf_wo_ext, TIMESTAMP_FORMAT)
-        except:
-            logging.warning(f'Found subfolder in {backup_path} without proper YYYYmmddHHMMSS ' \
-                                        f'format: {subfolder_leaf}. Ignoring.')
-            continue
-        backups_for_site[backup_datetime] = subfolder_leaf
+    with timed_span('scan existing backups'):
+        for subfolder in [ f.path for f in os.scandir(backup_path) if ( f.is_dir() and f.name != DB_STORE_DIR_NAME ) \
+            or ( f.is_file() and is_archive_file(f.path) ) ]:
+            subfolder_leaf = os.path.basename(subfolder)
+            subfolder_leaf_wo_ext = strip_archive(subfolder_leaf)
+            try:
+                backup_datetime = datetime.datetime.strptime(subfolder_leaf_wo_ext, TIMESTAMP_FORMAT)
+            except:
+                logging.warning(f'Found subfolder in {backup_path} without proper YYYYmmddHHMMSS ' \
+                                            f'format: {subfolder_leaf}. Ignoring.')
+                continue
+            backups_for_site[backup_datetime] = subfolder_leaf
     return [ ( x, backups_for_site[x] ) for x in sorted(backups_for_site) ]
 
 
@@ -330,6 +614,10 @@ def is_zip_file(file_name):
     return os.path.splitext(file_name)[1] == '.zip'
 
 
+def is_archive_file(file_name):
+    return any(file_name.endswith(x) for x in ARCHIVE_EXTENSIONS)
+
+
 def get_current_tracker_and_backups(site_name):
     global g
 
@@ -367,7 +655,7 @@ def get_current_tracker_and_backups(site_name):
     return (backups_tracker_current, existing_backups)
 
 
-def do_backup_if_time(site_name, site_data, backup_schedule):
+def do_backup_if_time(site_name, site_data, backup_schedule, do_maintenance=True):
     # Never do backups for websites with no backup schedule in vault.yml
     if backup_schedule is None:
         logging.info(f'Site {site_name} does not have backup schedule.  Skipping timed backup for this site')
@@ -395,7 +683,7 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
             if backup_interval in backups_tracker_current:
                 # Figure if we have to do backup for any of the backup intervals
                 most_recent_backup_stamp = backups_tracker_current[backup_interval][-1]
-                most_recent_backup_datetime = datetime.datetime.strptime(strip_zip(most_recent_backup_stamp),
+                most_recent_backup_datetime = datetime.datetime.strptime(strip_archive(most_recent_backup_stamp),
                     TIMESTAMP_FORMAT)
                 logging.debug(f'Most recent for {backup_interval} interval was {most_recent_backup_stamp}')
                 logging.debug(f'Time diff in secs for {backup_interval} is '\
@@ -408,21 +696,48 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
                 backups_tracker_new[backup_interval] = [g.datetime_start_string]
                 do_new_backup = True
 
+    # Defer the backup to the next run if the deadline has passed or it is not expected to finish within the time
+    # budget
+    if do_new_backup and g.deadline is not None:
+        remaining_seconds = get_remaining_seconds()
+        estimated_seconds = estimate_backup_seconds(site_name)
+        if remaining_seconds <= 0:
+            logging.warning(f'Deferring backup of site {site_name} to next run since the deadline has passed')
+            return
+        if estimated_seconds is not None and estimated_seconds > remaining_seconds:
+            logging.warning(f'Deferring backup of site {site_name} to next run since it is estimated to take ' \
+                f'{estimated_seconds:.0f} seconds and only {remaining_seconds:.0f} seconds remain')
+            return
+
     # Actually do the backup, retrieving WordPress DB and set of HTML files
     if do_new_backup:
-        do_backup(site_name, site_data, existing_backups)
+        if not do_backup(site_name, site_data, existing_backups):
+            return
         g.did_a_backup = True
     else:
         logging.info(f'No backups to do for site {site_name}')
 
     # Now update the JSON tracker file to associate the new backup set with backup interval(s)
     backups_tracker_updated = merge_backups_trackers(site_name, backups_tracker_current, backups_tracker_new)
-    json.dump(backups_tracker_updated, open(g.backups_dir_path + '/' + site_name + '/backups_tracker.json', 'w'))
+    save_backups_tracker(site_name, backups_tracker_updated)
 
     # Now again after updating tracker, get current backup tracker info from JSON file and scan existing backups
     # on disk *and* ensure they are in sync (else Exception is thrown)
     (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
 
+    if do_maintenance:
+        do_backup_maintenance(site_name, site_data)
+
+
+# Deletes aged out backups and compresses all but the newest backup of a site.  When running against a deadline,
+# whatever cannot be done in time is left for the next run, which recomputes both from the tracker.
+def do_backup_maintenance(site_name, site_data):
+    (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
+    if g.deadline is not None and get_remaining_seconds() <= 0:
+        logging.warning(f'Deferring deletion and compression of old backups of site {site_name} to next run ' \
+                        'since the deadline has passed')
+        return
+
     ###################################################################################################################
     # SECOND question: What old backups should be deleted?
     # Those backups no longer needed (aged out) across *all* backup intervals.  For example, if 'daily' backups
@@ -445,7 +760,7 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
     set_of_all_backups = { x for list_values in backups_tracker_current.values() for x in list_values }
     to_be_deleted = set_of_all_backups - set_of_backups_to_keep
     delete_backups(site_name, to_be_deleted)
-    json.dump(backups_tracker_new, open(g.backups_dir_path + '/' + site_name + '/backups_tracker.json', 'w'))
+    save_backups_tracker(site_name, backups_tracker_new)
 
     # Now again after updating tracker, get current backup tracker info from JSON file and scan existing backups
     # on disk *and* ensure they are in sync (else Exception is thrown)
@@ -461,8 +776,12 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
         set_based_backups_tracker[backup_interval] = set(backups_tracker_current[backup_interval])
     if len(existing_backups) > 1:
         for backup in existing_backups[:-1]:
-            if not is_zip_file(backup[1]):
-                compress_backup(site_name, backup[1])
+            if not is_archive_file(backup[1]):
+                if g.deadline is not None and get_remaining_seconds() <= 0:
+                    logging.warning(f'Deferring compression of backup {backup[1]} of site {site_name} to next run ' \
+                                    'since the deadline has passed')
+                    break
+                compress_backup(site_name, backup[1], get_filters(site_name, site_data))
                 for backup_interval in set_based_backups_tracker:
                     if backup[1] in set_based_backups_tracker[backup_interval]:
                         set_based_backups_tracker[backup_interval].remove(backup[1])
@@ -471,48 +790,507 @@ def do_backup_if_time(site_name, site_data, backup_schedule):
     backups_tracker_new = {}
     for backup_interval in set_based_backups_tracker:
         backups_tracker_new[backup_interval] = sorted(list(set_based_backups_tracker[backup_interval]))
-    json.dump(backups_tracker_new, open(g.backups_dir_path + '/' + site_name + '/backups_tracker.json', 'w'))
+    save_backups_tracker(site_name, backups_tracker_new)
 
     # One last time after all work done, get current backup tracker info from JSON file and scan existing backups
     # on disk *and* ensure they are in sync (else Exception is thrown)
     (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
 
 
-def strip_zip(file_name):
-    if len(file_name) > 4:
-        if file_name[-4:] == '.zip':
-            return file_name[:-4]
+def strip_archive(file_name):
+    for archive_extension in ARCHIVE_EXTENSIONS:
+        if len(file_name) > len(archive_extension) and file_name.endswith(archive_extension):
+            return file_name[:-len(archive_extension)]
     return file_name
 
 
-def compress_backup(site_name, backup_directory_name):
+def compress_backup(site_name, backup_directory_name, filters=None):
     global g
+    check_site_lease(site_name)
     backup_directory_path = g.backups_dir_path + '/' + site_name + '/' + backup_directory_name
     backup_directory_zip = backup_directory_path + '.zip'
     assert(os.path.isdir(backup_directory_path))
     assert(not(os.path.isfile(backup_directory_zip)))
     logging.info(f'Compressing backup {backup_directory_path} into {backup_directory_zip} ' \
                   '(can take a while for large sites)')
-    shutil.make_archive(backup_directory_path, 'zip', backup_directory_path)
-    shutil.rmtree(backup_directory_path)
+    # Backups taken before a site's filters were set up can still hold excluded files, so drop them (and refresh the
+    # manifest to match) before archiving
+    if filters and prune_excluded_files(backup_directory_path + '/files', filters) > 0 and \
+       os.path.isfile(backup_directory_path + '/' + MANIFEST_FILE_NAME):
+        with open(backup_directory_path + '/' + MANIFEST_FILE_NAME, 'rb') as manifest_file:
+            write_manifest(backup_directory_path, read_manifest(manifest_file))
+    if os.path.isfile(backup_directory_path + '/db/database.sql'):
+        store_db_dump(site_name, backup_directory_name, backup_directory_path + '/db/database.sql')
+    with timed_span('zip deflate'):
+        shutil.make_archive(backup_directory_path, 'zip', backup_directory_path)
+    with timed_span('rmtree'):
+        shutil.rmtree(backup_directory_path)
     logging.info(f'Compressed backup {backup_directory_path} into {backup_directory_zip}')
     return
 
 
 def delete_backups(site_name, to_be_deleted):
     global g
+    check_site_lease(site_name)
+    remove_db_dumps(site_name, to_be_deleted)
     for delete_backup in to_be_deleted:
         delete_file_path = g.backups_dir_path + '/' + site_name + '/' + delete_backup
-        if is_zip_file(delete_file_path):
+        if is_archive_file(delete_file_path):
             assert(os.path.isfile(delete_file_path))
             os.remove(delete_file_path)
-            logging.info(f"Backup zip file '{delete_file_path}' deleted")
+            logging.info(f"Backup archive file '{delete_file_path}' deleted")
         else:
             assert(os.path.isdir(delete_file_path))
-            shutil.rmtree(delete_file_path)
+            with timed_span('rmtree'):
+                shutil.rmtree(delete_file_path)
             logging.info(f"Backup file directory '{delete_file_path}' deleted")
 
 
+# Recompresses a site's zipped backups kept for RECOMPRESS_TIERS into .tar.zst archives, several at once, and renames
+# them in the tracker with a single update.  Sizes before and after are added up per tier in recompress_results, where
+# a backup kept for several tiers counts towards the longest lived one.
+def recompress_site(site_name, recompress_results):
+    if shutil.which('zstd') is None:
+        err_string = 'Recompressing backups requires zstd, which was not found'
+        logging.error(err_string)
+        raise Exception(err_string)
+    (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
+    backup_tiers = {}
+    for tier in RECOMPRESS_TIERS:
+        for backup in backups_tracker_current.get(tier, []):
+            if is_zip_file(backup):
+                backup_tiers.setdefault(backup, tier)
+    if not backup_tiers:
+        logging.info(f'No backups to recompress for site {site_name}')
+        return
+    logging.info(f'Recompressing {len(backup_tiers)} backups of site {site_name}')
+
+    renamed_backups = {}
+    errors = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=RECOMPRESS_MAX_WORKERS) as executor:
+            futures = { executor.submit(recompress_backup, site_name, x): x for x in sorted(backup_tiers) }
+            for future in concurrent.futures.as_completed(futures):
+                backup = futures[future]
+                try:
+                    sizes = future.result()
+                except Exception as e:
+                    errors.append(f'{backup}: {e}')
+                    continue
+                if sizes is None:
+                    continue
+                renamed_backups[backup] = strip_archive(backup) + TAR_ZST_EXTENSION
+                tier_results = recompress_results.setdefault(backup_tiers[backup],
+                    { 'backups': 0, 'bytes_before': 0, 'bytes_after': 0 })
+                tier_results['backups'] += 1
+                tier_results['bytes_before'] += sizes[0]
+                tier_results['bytes_after'] += sizes[1]
+    finally:
+        if renamed_backups:
+            save_backups_tracker(site_name, { x: [ renamed_backups.get(y, y) for y in backups_tracker_current[x] ]
+                                              for x in backups_tracker_current })
+    if errors:
+        err_string = f'Recompressing backups of site {site_name} failed for: {"; ".join(errors)}'
+        logging.error(err_string)
+        raise Exception(err_string)
+    get_current_tracker_and_backups(site_name)
+
+
+# Rewrites a zipped backup as a tar archive (manifest first, so it can be read without decompressing the rest) piped
+# through a niced zstd, verifies every file against the CRCs recorded in the zip, and then replaces the zip.  Returns
+# archive sizes before and after, or None if the deadline has passed.
+def recompress_backup(site_name, backup_name):
+    if g.deadline is not None and get_remaining_seconds() <= 0:
+        logging.warning(f'Deferring recompression of backup {backup_name} of site {site_name} to next run since ' \
+                        'the deadline has passed')
+        return None
+    site_path = g.backups_dir_path + '/' + site_name
+    zip_path = site_path + '/' + backup_name
+    archive_path = site_path + '/' + strip_archive(backup_name) + TAR_ZST_EXTENSION
+    temp_archive_path = archive_path + '.tmp'
+    zstd_command = [ 'nice', '-n', str(RECOMPRESS_NICE), 'zstd', '-q', '-f', *RECOMPRESS_ZSTD_ARGS.split(),
+                     f'-T{RECOMPRESS_ZSTD_THREADS}', '-o', temp_archive_path ]
+    logging.info(f'Recompressing backup {zip_path} into {archive_path}')
+    try:
+        with zipfile.ZipFile(zip_path) as backup_zip, timed_span('recompress', is_subprocess=True):
+            zip_infos = sorted(backup_zip.infolist(), key=lambda x: x.filename != MANIFEST_FILE_NAME)
+            process = subprocess.Popen(zstd_command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                with tarfile.open(fileobj=process.stdin, mode='w|', format=tarfile.PAX_FORMAT) as backup_tar:
+                    for zip_info in zip_infos:
+                        if zip_info.is_dir():
+                            backup_tar.addfile(get_tar_info(zip_info))
+                        else:
+                            with backup_zip.open(zip_info) as member_file:
+                                backup_tar.addfile(get_tar_info(zip_info), member_file)
+            finally:
+                with contextlib.suppress(BrokenPipeError):
+                    process.stdin.close()
+                zstd_error = process.stderr.read()
+                process.stderr.close()
+                returncode = process.wait()
+            if returncode != 0:
+                raise Exception(f'zstd exited with error status {returncode} and error: {zstd_error}')
+            verify_recompressed_backup(temp_archive_path, zip_infos)
+    except Exception:
+        if os.path.isfile(temp_archive_path):
+            os.remove(temp_archive_path)
+        raise
+    sizes = (os.path.getsize(zip_path), os.path.getsize(temp_archive_path))
+    os.replace(temp_archive_path, archive_path)
+    os.remove(zip_path)
+    logging.info(f'Recompressed backup {zip_path} into {archive_path} ({sizes[0]:,} -> {sizes[1]:,} bytes)')
+    return sizes
+
+
+def get_tar_info(zip_info):
+    tar_info = tarfile.TarInfo(zip_info.filename.rstrip('/'))
+    tar_info.mtime = time.mktime(zip_info.date_time + (0, 0, -1))
+    mode = stat.S_IMODE(zip_info.external_attr >> 16)
+    if zip_info.is_dir():
+        tar_info.type = tarfile.DIRTYPE
+        tar_info.mode = mode or 0o755
+    else:
+        tar_info.size = zip_info.file_size
+        tar_info.mode = mode or 0o644
+    return tar_info
+
+
+def verify_recompressed_backup(archive_path, zip_infos):
+    expected_members = { x.filename.rstrip('/'): x for x in zip_infos }
+    process = subprocess.Popen(['zstd', '-q', '-dc', ZSTD_LONG_ARG, archive_path], stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as archive_tar:
+            for member in archive_tar:
+                zip_info = expected_members.pop(member.name, None)
+                if zip_info is None:
+                    raise Exception(f'Recompressed archive {archive_path} has unexpected member {member.name}')
+                if not member.isfile():
+                    continue
+                member_file = archive_tar.extractfile(member)
+                crc = 0
+                for chunk in iter(lambda: member_file.read(1024 * 1024), b''):
+                    crc = zlib.crc32(chunk, crc)
+                if crc != zip_info.CRC or member.size != zip_info.file_size:
+                    raise Exception(f'Recompressed archive {archive_path} does not match zip for {member.name}')
+    finally:
+        process.kill()
+        process.wait()
+        process.stdout.close()
+    if expected_members:
+        raise Exception(f'Recompressed archive {archive_path} is missing {len(expected_members)} members, e.g. ' \
+                        f'{next(iter(expected_members))}')
+
+
+def print_recompress_report(recompress_results):
+    print(f'{"Interval":<10} {"Backups":>8} {"Before":>16} {"After":>16} {"Reclaimed":>16}')
+    totals = { 'backups': 0, 'bytes_before': 0, 'bytes_after': 0 }
+    for tier in [ x for x in RECOMPRESS_TIERS if x in recompress_results ] + [ 'total' ]:
+        tier_results = totals if tier == 'total' else recompress_results[tier]
+        print(f"{tier:<10} {tier_results['backups']:>8} {tier_results['bytes_before']:>16,} " \
+              f"{tier_results['bytes_after']:>16,} {tier_results['bytes_before'] - tier_results['bytes_after']:>16,}")
+        if tier != 'total':
+            for key in totals:
+                totals[key] += tier_results[key]
+
+
+# Writes a site's tracker atomically while holding its tracker lease
+def save_backups_tracker(site_name, backups_tracker):
+    check_site_lease(site_name)
+    tracker_lease = Lease(site_name, 'tracker')
+    tracker_lease.acquire(wait_seconds=LEASE_SECONDS)
+    try:
+        backups_tracker_filename = g.backups_dir_path + '/' + site_name + '/backups_tracker.json'
+        json.dump(backups_tracker, open(backups_tracker_filename + '.tmp', 'w'))
+        os.replace(backups_tracker_filename + '.tmp', backups_tracker_filename)
+    finally:
+        tracker_lease.release()
+
+
+# A lease on a site (kind 'site') or its tracker (kind 'tracker') held by this node.  The lease file records the owner
+# and when it expires.  A lease can be claimed when its file does not exist or has expired.  An expired lease is taken
+# over by replacing its file and then reading it back, so when two nodes race for it only the last writer keeps it.
+class Lease:
+    def __init__(self, site_name, kind):
+        self.site_name = site_name
+        self.kind = kind
+        self.path = g.backups_dir_path + '/' + LEASES_DIR_NAME + '/' + site_name + '.' + kind + '.lease'
+        self.token = uuid.uuid4().hex
+        self.acquired = None
+        self.held = False
+        self.heartbeat_thread = None
+        self.stop_heartbeat = threading.Event()
+        self.lost = False
+
+    def make_record(self):
+        now = time.time()
+        return { 'node': g.node_name, 'pid': os.getpid(), 'token': self.token, 'site': self.site_name,
+                 'kind': self.kind, 'acquired': self.acquired or now, 'heartbeat': now, 'expires': now + LEASE_SECONDS }
+
+    def write_record(self):
+        temp_path = self.path + '.' + self.token
+        json.dump(self.make_record(), open(temp_path, 'w'))
+        os.replace(temp_path, self.path)
+
+    # Returns True if the lease was claimed.  With wait_seconds, keeps trying that long and raises if still unavailable.
+    def acquire(self, wait_seconds=0, heartbeat=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        deadline = time.monotonic() + wait_seconds
+        while not self.try_acquire():
+            if time.monotonic() >= deadline:
+                if wait_seconds:
+                    holder = read_lease(self.path) or {}
+                    err_string = f"Timed out waiting for {self.kind} lease of site {self.site_name} held by node " \
+                        f"{holder.get('node')}"
+                    logging.error(err_string)
+                    raise Exception(err_string)
+                return False
+            time.sleep(1)
+        self.held = True
+        if heartbeat:
+            self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+            self.heartbeat_thread.start()
+        return True
+
+    def try_acquire(self):
+        self.acquired = time.time()
+        try:
+            lease_fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            holder = read_lease(self.path)
+            if holder is not None and holder['expires'] > time.time():
+                return False
+            if holder is not None:
+                logging.warning(f"Taking over expired {self.kind} lease of site {self.site_name} from node " \
+                                f"{holder['node']}")
+            self.write_record()
+            time.sleep(0.1)
+            holder = read_lease(self.path)
+            return holder is not None and holder['token'] == self.token
+        with os.fdopen(lease_fd, 'w') as lease_file:
+            json.dump(self.make_record(), lease_file)
+        return True
+
+    def heartbeat(self):
+        while not self.stop_heartbeat.wait(LEASE_HEARTBEAT_SECONDS):
+            holder = read_lease(self.path)
+            if holder is None or holder['token'] != self.token:
+                logging.error(f'Lost {self.kind} lease of site {self.site_name} to node ' \
+                              f"{holder['node'] if holder else None}; stopping work on the site")
+                self.lost = True
+                terminate_running_commands()
+                return
+            self.write_record()
+
+    # True while this lease is held and its file still names it as the owner
+    def is_held(self):
+        if not self.held or self.lost:
+            return False
+        holder = read_lease(self.path)
+        return holder is not None and holder['token'] == self.token
+
+    def release(self):
+        self.stop_heartbeat.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+        if self.held:
+            holder = read_lease(self.path)
+            if holder is not None and holder['token'] == self.token:
+                os.remove(self.path)
+            self.held = False
+
+
+# Raises LeaseLost unless this process still holds the site lease of a site, so a node that lost a site to another
+# node stops changing its backups and tracker
+def check_site_lease(site_name):
+    site_lease = g.site_leases.get(site_name)
+    if site_lease is None or not site_lease.is_held():
+        err_string = f'Not changing backups of site {site_name} since this node does not hold its site lease'
+        logging.error(err_string)
+        raise LeaseLost(err_string)
+
+
+# Returns a lease file's record, or None if it does not exist.  A lease file that cannot be parsed (caught mid-write)
+# is treated as held for a heartbeat interval from its modification time.
+def read_lease(lease_path):
+    try:
+        with open(lease_path) as lease_file:
+            return json.load(lease_file)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        try:
+            expires = os.path.getmtime(lease_path) + LEASE_HEARTBEAT_SECONDS
+        except FileNotFoundError:
+            return None
+        return { 'node': None, 'pid': None, 'token': None, 'expires': expires, 'heartbeat': None }
+
+
+def print_lease_status():
+    leases_path = g.backups_dir_path + '/' + LEASES_DIR_NAME
+    lease_file_names = sorted(x for x in os.listdir(leases_path) if x.endswith('.lease')) \
+        if os.path.isdir(leases_path) else []
+    if not lease_file_names:
+        print('No sites are leased by any node')
+        return
+    now = time.time()
+    print(f"{'Site':30} {'Lease':8} {'Node':25} {'PID':>8} {'Held for':>10} {'Heartbeat':>10} {'State':8}")
+    for lease_file_name in lease_file_names:
+        holder = read_lease(leases_path + '/' + lease_file_name)
+        if holder is None:
+            continue
+        (site_name, kind) = lease_file_name[:-len('.lease')].rsplit('.', 1)
+        held_for = f"{now - holder['acquired']:.0f}s" if holder.get('acquired') else '-'
+        heartbeat_age = f"{now - holder['heartbeat']:.0f}s ago" if holder.get('heartbeat') else '-'
+        state = 'held' if holder['expires'] > now else 'expired'
+        print(f"{site_name:30} {kind:8} {str(holder['node']):25} {str(holder['pid']):>8} {held_for:>10} " \
+              f"{heartbeat_age:>10} {state:8}")
+
+
+def get_db_store_index(site_name):
+    db_store_index_filename = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME + '/index.json'
+    if os.path.isfile(db_store_index_filename):
+        with open(db_store_index_filename) as db_store_index_file:
+            return json.load(db_store_index_file)
+    return {}
+
+
+def save_db_store_index(site_name, db_store_index):
+    db_store_index_filename = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME + '/index.json'
+    json.dump(db_store_index, open(db_store_index_filename + '.tmp', 'w'))
+    os.replace(db_store_index_filename + '.tmp', db_store_index_filename)
+
+
+# Encodes a dump into db_store as a keyframe (base_dump_path None) or a delta against base_dump_path, and returns the
+# store file name
+def encode_db_dump(site_name, backup_stamp, dump_path, base_stamp=None, base_dump_path=None):
+    db_store_path = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME
+    if base_stamp is None:
+        store_file_name = backup_stamp + '.sql.zst'
+        zstd_string = f'zstd -q -f -T0 {ZSTD_LONG_ARG} {shlex.quote(dump_path)} -o ' \
+            f'{shlex.quote(db_store_path + "/" + store_file_name)}'
+    else:
+        store_file_name = backup_stamp + '.from-' + base_stamp + '.sql.zstpatch'
+        zstd_string = f'zstd -q -f -T0 {ZSTD_LONG_ARG} --patch-from={shlex.quote(base_dump_path)} ' \
+            f'{shlex.quote(dump_path)} -o {shlex.quote(db_store_path + "/" + store_file_name)}'
+    run_zstd(zstd_string)
+    return store_file_name
+
+
+# Rebuilds the full dump of a backup from db_store into output_path
+def rebuild_db_dump(site_name, backup_stamp, output_path, db_store_index):
+    db_store_path = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME
+    entry = db_store_index[backup_stamp]
+    store_file_path = db_store_path + '/' + entry['file']
+    if entry['base'] is None:
+        run_zstd(f'zstd -q -d -f {ZSTD_LONG_ARG} {shlex.quote(store_file_path)} -o {shlex.quote(output_path)}')
+        return
+    with tempfile.TemporaryDirectory(dir=db_store_path) as temp_dir_path:
+        base_dump_path = temp_dir_path + '/base.sql'
+        rebuild_db_dump(site_name, entry['base'], base_dump_path, db_store_index)
+        run_zstd(f'zstd -q -d -f {ZSTD_LONG_ARG} --patch-from={shlex.quote(base_dump_path)} ' \
+            f'{shlex.quote(store_file_path)} -o {shlex.quote(output_path)}')
+
+
+# Runs zstd on db_store files.  Not cancellable, so db_store and its index are never left half updated at the deadline.
+def run_zstd(zstd_string):
+    logging.debug(f'Executing: {zstd_string}')
+    try:
+        with timed_span('zstd', is_subprocess=True):
+            run_command(zstd_string, 'zstd', cancellable=False)
+    except subprocess.CalledProcessError as e:
+        err_string = 'zstd exited with error status ' + str(e.returncode) + ' and error: ' + str(e.output)
+        logging.error(err_string)
+        raise Exception(err_string)
+
+
+# Moves the database dump of a backup being zipped into db_store, as a delta against the latest keyframe if it has
+# room for more dependents, else as a new keyframe.  The encoded dump is verified by rebuilding it before the original
+# is removed.  Without zstd installed the dump simply stays in the backup.
+def store_db_dump(site_name, backup_directory_name, dump_path):
+    if shutil.which('zstd') is None:
+        return
+    backup_stamp = strip_archive(backup_directory_name)
+    db_store_path = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME
+    os.makedirs(db_store_path, exist_ok=True)
+    db_store_index = get_db_store_index(site_name)
+    keyframes = sorted(x for x in db_store_index if db_store_index[x]['base'] is None)
+    base_stamp = None
+    if keyframes and len([ x for x in db_store_index if db_store_index[x]['base'] == keyframes[-1] ]) < \
+       DB_DELTA_MAX_DEPENDENTS:
+        base_stamp = keyframes[-1]
+
+    with tempfile.TemporaryDirectory(dir=db_store_path) as temp_dir_path:
+        if base_stamp is None:
+            store_file_name = encode_db_dump(site_name, backup_stamp, dump_path)
+        else:
+            base_dump_path = temp_dir_path + '/base.sql'
+            rebuild_db_dump(site_name, base_stamp, base_dump_path, db_store_index)
+            store_file_name = encode_db_dump(site_name, backup_stamp, dump_path, base_stamp, base_dump_path)
+        db_store_index[backup_stamp] = { 'file': store_file_name, 'base': base_stamp }
+        rebuild_db_dump(site_name, backup_stamp, temp_dir_path + '/check.sql', db_store_index)
+        if hash_file(temp_dir_path + '/check.sql') != hash_file(dump_path):
+            os.remove(db_store_path + '/' + store_file_name)
+            err_string = f'Database dump of backup {backup_stamp} for site {site_name} did not rebuild correctly ' \
+                f'from {store_file_name}'
+            logging.error(err_string)
+            raise Exception(err_string)
+    save_db_store_index(site_name, db_store_index)
+    os.remove(dump_path)
+    logging.info(f"Stored database dump of backup {backup_stamp} for site {site_name} as {store_file_name} " \
+                 f"({os.path.getsize(db_store_path + '/' + store_file_name):,} bytes)")
+
+
+# Removes db_store entries of backups being deleted.  Deltas that depend on a keyframe being deleted are rebuilt and
+# re-encoded first: the newest becomes the new keyframe and the rest become deltas against it.
+def remove_db_dumps(site_name, to_be_deleted):
+    db_store_index = get_db_store_index(site_name)
+    stamps_to_delete = { strip_archive(x) for x in to_be_deleted } & db_store_index.keys()
+    if not stamps_to_delete:
+        return
+    db_store_path = g.backups_dir_path + '/' + site_name + '/' + DB_STORE_DIR_NAME
+    for keyframe in sorted(x for x in stamps_to_delete if db_store_index[x]['base'] is None):
+        dependents = sorted(x for x in db_store_index if db_store_index[x]['base'] == keyframe and
+                            x not in stamps_to_delete)
+        if not dependents:
+            continue
+        logging.info(f'Re-encoding {len(dependents)} database dumps of site {site_name} that depend on keyframe ' \
+                     f'{keyframe} which is being deleted')
+        with tempfile.TemporaryDirectory(dir=db_store_path) as temp_dir_path:
+            for dependent in dependents:
+                rebuild_db_dump(site_name, dependent, temp_dir_path + '/' + dependent + '.sql', db_store_index)
+            new_keyframe = dependents[-1]
+            old_files = [ db_store_index[x]['file'] for x in dependents ]
+            new_keyframe_dump_path = temp_dir_path + '/' + new_keyframe + '.sql'
+            db_store_index[new_keyframe] = { 'file': encode_db_dump(site_name, new_keyframe, new_keyframe_dump_path),
+                                             'base': None }
+            for dependent in dependents[:-1]:
+                db_store_index[dependent] = { 'file': encode_db_dump(site_name, dependent,
+                    temp_dir_path + '/' + dependent + '.sql', new_keyframe, new_keyframe_dump_path),
+                    'base': new_keyframe }
+            save_db_store_index(site_name, db_store_index)
+            for old_file in old_files:
+                os.remove(db_store_path + '/' + old_file)
+    for stamp in stamps_to_delete:
+        os.remove(db_store_path + '/' + db_store_index[stamp]['file'])
+        del db_store_index[stamp]
+        logging.info(f'Database dump of backup {stamp} for site {site_name} removed from {DB_STORE_DIR_NAME}')
+    save_db_store_index(site_name, db_store_index)
+
+
+def extract_db_dump(site_name, backup_stamp):
+    db_store_index = get_db_store_index(site_name)
+    if strip_archive(backup_stamp) not in db_store_index:
+        err_string = f'No database dump for backup {backup_stamp} of site {site_name} in {DB_STORE_DIR_NAME} (dumps ' \
+            'of unzipped backups, and of backups zipped without zstd installed, are in the db folder of the backup)'
+        logging.error(err_string)
+        raise Exception(err_string)
+    output_path = os.path.abspath(f'{site_name}_{strip_archive(backup_stamp)}_database.sql')
+    rebuild_db_dump(site_name, strip_archive(backup_stamp), output_path, db_store_index)
+    print(f'Site: {site_name} database dump of backup {strip_archive(backup_stamp)} written to {output_path}')
+
+
 def get_current_backups_tracker(site_name):
     backups_tracker_filename = g.backups_dir_path + '/' + site_name + '/backups_tracker.json'
     if os.path.isfile(backups_tracker_filename):
@@ -521,20 +1299,438 @@ def get_current_backups_tracker(site_name):
     else:
         current_backups_tracker = {}
     return current_backups_tracker
-    
+
+
+def write_backup_manifest(site_name, existing_backups):
+    global g
+    backup_directory_path = g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string
+    previous_backup = existing_backups[-1][1] if existing_backups else None
+
+    # Hashes of files whose size and mtime are unchanged since the previous backup are carried over from its manifest
+    # rather than recomputed
+    logging.info(f'Writing manifest for {backup_directory_path}')
+    with open_manifest(site_name, previous_backup) as previous_manifest_file:
+        if previous_manifest_file is None:
+            previous_records = iter(())
+        else:
+            previous_records = read_manifest(previous_manifest_file)
+        with timed_span('manifest'):
+            write_manifest(backup_directory_path, previous_records)
+
+    if previous_backup is None:
+        return None
+    changes = summarize_changes(site_name, previous_backup, g.datetime_start_string)
+    if changes is not None:
+        logging.info(f"Changes since backup {previous_backup} for site {site_name}: {changes['added']} added, " \
+            f"{changes['deleted']} deleted, {changes['modified']} modified " \
+            f"({changes['bytes_changed']:,} bytes in added or modified files)")
+    return changes
+
+
+def write_manifest(backup_directory_path, previous_records):
+    # Collect and sort relative paths first (as bytes, which is the manifest sort order) since os.walk() does not
+    # visit files in full path order
+    relative_paths = []
+    for dir_path, dir_names, file_names in os.walk(backup_directory_path):
+        # os.walk() lists symbolic links to directories among dir_names (without following them), so they are
+        # recorded here like links to files
+        for file_name in file_names + [ x for x in dir_names if os.path.islink(os.path.join(dir_path, x)) ]:
+            relative_path = os.path.relpath(os.path.join(dir_path, file_name), backup_directory_path)
+            if relative_path in (MANIFEST_FILE_NAME, 'messages.log'):
+                continue
+            relative_paths.append(os.fsencode(relative_path))
+    relative_paths.sort()
+
+    previous_record = next(previous_records, None)
+    manifest_file_path = backup_directory_path + '/' + MANIFEST_FILE_NAME
+    with open(manifest_file_path + '.tmp', 'wb') as manifest_file:
+        manifest_file.write(MANIFEST_MAGIC)
+        for relative_path in relative_paths:
+            file_path = os.path.join(os.fsencode(backup_directory_path), relative_path)
+            file_stat = os.lstat(file_path)
+            while previous_record is not None and previous_record[0] < relative_path:
+                previous_record = next(previous_records, None)
+            if previous_record is not None and previous_record[0] == relative_path and \
+               previous_record[1] == file_stat.st_size and previous_record[2] == file_stat.st_mtime_ns:
+                digest = previous_record[3]
+            else:
+                digest = hash_file(file_path)
+            manifest_file.write(MANIFEST_RECORD.pack(file_stat.st_size, file_stat.st_mtime_ns, digest,
+                len(relative_path)))
+            manifest_file.write(relative_path)
+    os.replace(manifest_file_path + '.tmp', manifest_file_path)
+
+
+def hash_file(file_path):
+    file_hash = hashlib.blake2b(digest_size=16)
+    if os.path.islink(file_path):
+        # Symbolic links (preserved by rsync -a) are identified by their target rather than followed
+        file_hash.update(os.readlink(file_path))
+        return file_hash.digest()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.digest()
+
+
+@contextlib.contextmanager
+def open_manifest(site_name, backup_name):
+    global g
+    if backup_name is None:
+        yield None
+        return
+    backup_path = g.backups_dir_path + '/' + site_name + '/' + backup_name
+    if is_zip_file(backup_path):
+        with zipfile.ZipFile(backup_path) as backup_zip:
+            if MANIFEST_FILE_NAME not in backup_zip.namelist():
+                yield None
+                return
+            with backup_zip.open(MANIFEST_FILE_NAME) as manifest_file:
+                yield manifest_file
+    elif backup_path.endswith(TAR_ZST_EXTENSION):
+        # The manifest is the first member of recompressed archives, so only the start of the archive is decompressed
+        process = subprocess.Popen(['zstd', '-q', '-dc', ZSTD_LONG_ARG, backup_path], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode='r|') as backup_tar:
+                member = backup_tar.next()
+                if member is None or member.name != MANIFEST_FILE_NAME:
+                    yield None
+                    return
+                yield backup_tar.extractfile(member)
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+    elif os.path.isfile(backup_path + '/' + MANIFEST_FILE_NAME):
+        with open(backup_path + '/' + MANIFEST_FILE_NAME, 'rb') as manifest_file:
+            yield manifest_file
+    else:
+        yield None
+
+
+# Generates (path, size, mtime_ns, digest) tuples from an open manifest file, one record at a time
+def read_manifest(manifest_file):
+    if manifest_file.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+        raise Exception('Manifest file does not start with expected header. Is it corrupt?')
+    while True:
+        fixed_part = manifest_file.read(MANIFEST_RECORD.size)
+        if not fixed_part:
+            return
+        (size, mtime_ns, digest, path_length) = MANIFEST_RECORD.unpack(fixed_part)
+        yield (manifest_file.read(path_length), size, mtime_ns, digest)
+
+
+# Merge-joins two sorted manifest record streams and generates ('A'|'D'|'M', path, old_record, new_record) for each
+# added, deleted or modified file.  Runs in O(n) time and constant memory.
+def diff_manifests(old_records, new_records):
+    old_record = next(old_records, None)
+    new_record = next(new_records, None)
+    while old_record is not None or new_record is not None:
+        if new_record is None or (old_record is not None and old_record[0] < new_record[0]):
+            yield ('D', old_record[0], old_record, None)
+            old_record = next(old_records, None)
+        elif old_record is None or new_record[0] < old_record[0]:
+            yield ('A', new_record[0], None, new_record)
+            new_record = next(new_records, None)
+        else:
+            if old_record[1] != new_record[1] or old_record[3] != new_record[3]:
+                yield ('M', new_record[0], old_record, new_record)
+            old_record = next(old_records, None)
+            new_record = next(new_records, None)
+
+
+# Returns counts of added, deleted and modified files between two backups of a site, or None if either backup
+# lacks a manifest
+def summarize_changes(site_name, old_backup, new_backup):
+    changes = { 'added': 0, 'deleted': 0, 'modified': 0, 'bytes_changed': 0 }
+    with open_manifest(site_name, old_backup) as old_manifest_file, \
+         open_manifest(site_name, new_backup) as new_manifest_file:
+        if old_manifest_file is None or new_manifest_file is None:
+            return None
+        for (change, path, old_record, new_record) in diff_manifests(read_manifest(old_manifest_file),
+                                                                     read_manifest(new_manifest_file)):
+            if change == 'A':
+                changes['added'] += 1
+            elif change == 'D':
+                changes['deleted'] += 1
+            else:
+                changes['modified'] += 1
+            if new_record is not None:
+                changes['bytes_changed'] += new_record[1]
+    return changes
+
+
+def find_backup(site_name, backup_stamp, existing_backups):
+    for existing_backup in existing_backups:
+        if strip_archive(existing_backup[1]) == strip_archive(backup_stamp):
+            return existing_backup[1]
+    err_string = f'Cannot find backup {backup_stamp} for site {site_name}'
+    logging.error(err_string)
+    raise Exception(err_string)
+
+
+def diff_backups(site_name, old_backup_stamp, new_backup_stamp):
+    existing_backups = get_existing_backups(site_name)
+    old_backup = find_backup(site_name, old_backup_stamp, existing_backups)
+    new_backup = find_backup(site_name, new_backup_stamp, existing_backups)
+    print(f'Site: {site_name} ({old_backup} -> {new_backup})')
+    counts = { 'A': 0, 'D': 0, 'M': 0 }
+    with open_manifest(site_name, old_backup) as old_manifest_file, \
+         open_manifest(site_name, new_backup) as new_manifest_file:
+        for (manifest_file, backup) in [ (old_manifest_file, old_backup), (new_manifest_file, new_backup) ]:
+            if manifest_file is None:
+                err_string = f'Backup {backup} for site {site_name} has no {MANIFEST_FILE_NAME} to diff against'
+                logging.error(err_string)
+                raise Exception(err_string)
+        for (change, path, old_record, new_record) in diff_manifests(read_manifest(old_manifest_file),
+                                                                     read_manifest(new_manifest_file)):
+            counts[change] += 1
+            print(f'{change} {os.fsdecode(path)}')
+    print(f"{counts['A']} added, {counts['D']} deleted, {counts['M']} modified")
+
+
+# Parses --replicate-to into a dict describing the target.  Credentials for S3-compatible targets come from the
+# optional 'replication' section of vault.yml (endpoint_url, access_key, secret_key).
+def parse_replication_target(target_string, replication_settings):
+    if target_string.startswith('ssh://'):
+        ssh_match = re.match(r'^ssh://([^@/]+)@([^:/]+)(?::(\d+))?(/.*)$', target_string)
+        if not ssh_match:
+            err_string = f"SSH replication target '{target_string}' must be in ssh://user@host[:port]/path format"
+            logging.error(err_string)
+            raise Exception(err_string)
+        return { 'name': target_string, 'kind': 'ssh', 'username': ssh_match.group(1),
+                 'hostname': ssh_match.group(2), 'port': int(ssh_match.group(3) or 22),
+                 'path': ssh_match.group(4).rstrip('/') }
+    elif target_string.startswith('s3://'):
+        try:
+            import boto3
+            import boto3.s3.transfer
+        except ImportError:
+            err_string = 'Replicating to an s3:// target requires the boto3 package (pip install boto3)'
+            logging.error(err_string)
+            raise Exception(err_string)
+        (bucket, _, prefix) = target_string[len('s3://'):].partition('/')
+        s3_client = boto3.client('s3', endpoint_url=replication_settings.get('endpoint_url'),
+            aws_access_key_id=replication_settings.get('access_key'),
+            aws_secret_access_key=replication_settings.get('secret_key'))
+        transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=REPLICATION_MULTIPART_CHUNK_SIZE,
+            multipart_chunksize=REPLICATION_MULTIPART_CHUNK_SIZE, max_concurrency=REPLICATION_MULTIPART_CONCURRENCY)
+        return { 'name': target_string, 'kind': 's3', 'bucket': bucket, 'prefix': prefix.strip('/'),
+                 'client': s3_client, 'transfer_config': transfer_config }
+    else:
+        target_path = os.path.abspath(target_string)
+        if Path(g.backups_dir_path) == Path(target_path) or Path(g.backups_dir_path) in Path(target_path).parents:
+            err_string = f'Replication target {target_path} cannot be within backups directory {g.backups_dir_path}'
+            logging.error(err_string)
+            raise Exception(err_string)
+        return { 'name': target_path, 'kind': 'dir', 'path': target_path }
+
+
+# Pushes zipped backups of a site not yet at the target, removes ones at the target no longer tracked, and updates the
+# tracker copy at the target if it changed.  The watermark of what each target holds is kept in
+# replication_state.json, so the cost of a run is proportional to what changed since the last one.
+def replicate_site(site_name, replication_target):
+    global g
+    site_path = g.backups_dir_path + '/' + site_name
+    if not os.path.isdir(site_path):
+        logging.info(f'No backups to replicate for site {site_name}')
+        return
+    (backups_tracker_current, existing_backups) = get_current_tracker_and_backups(site_name)
+    replication_state = get_replication_state()
+    site_state = replication_state.setdefault(replication_target['name'], {}).setdefault(site_name,
+        { 'backups': [], 'tracker_hash': None })
+
+    current_backups = { x[1] for x in existing_backups if is_archive_file(x[1]) }
+    current_backups |= { DB_STORE_DIR_NAME + '/' + x['file'] for x in get_db_store_index(site_name).values() }
+    replicated_backups = set(site_state['backups'])
+    to_push = sorted(current_backups - replicated_backups)
+    to_remove = sorted(replicated_backups - current_backups)
+    logging.info(f'Replicating site {site_name} to {replication_target["name"]}: {len(to_push)} backups to push, ' \
+                 f'{len(to_remove)} to remove')
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=REPLICATION_MAX_WORKERS) as executor:
+        futures = { executor.submit(replicate_file, replication_target, site_path + '/' + x,
+            site_name + '/' + x): x for x in to_push }
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                replicated_backups.add(futures[future])
+                logging.info(f'Replicated {site_name}/{futures[future]} to {replication_target["name"]}')
+            except Exception as e:
+                errors.append(f'{futures[future]}: {e}')
+    for backup in to_remove:
+        try:
+            replicate_delete(replication_target, site_name + '/' + backup)
+            replicated_backups.discard(backup)
+            logging.info(f'Removed {site_name}/{backup} from {replication_target["name"]}')
+        except Exception as e:
+            errors.append(f'{backup}: {e}')
+
+    # The newest backup is not zipped yet and so not replicated, so the target gets a tracker listing only the backups
+    # it holds (keeping it in sync with them), pushed after them and only when it changed
+    replicated_tracker = { x: [ y for y in backups_tracker_current[x] if y in replicated_backups ]
+                           for x in backups_tracker_current }
+    replicated_tracker_content = json.dumps(replicated_tracker).encode()
+    tracker_hash = hashlib.blake2b(replicated_tracker_content, digest_size=16).hexdigest()
+    if not errors and tracker_hash != site_state['tracker_hash']:
+        with tempfile.TemporaryDirectory() as temp_dir_path:
+            Path(temp_dir_path + '/backups_tracker.json').write_bytes(replicated_tracker_content)
+            replicate_file(replication_target, temp_dir_path + '/backups_tracker.json',
+                site_name + '/backups_tracker.json')
+        site_state['tracker_hash'] = tracker_hash
+    db_store_index_path = site_path + '/' + DB_STORE_DIR_NAME + '/index.json'
+    if not errors and os.path.isfile(db_store_index_path):
+        db_store_index_hash = hashlib.blake2b(open(db_store_index_path, 'rb').read(), digest_size=16).hexdigest()
+        if db_store_index_hash != site_state.get('db_store_index_hash'):
+            replicate_file(replication_target, db_store_index_path,
+                site_name + '/' + DB_STORE_DIR_NAME + '/index.json')
+            site_state['db_store_index_hash'] = db_store_index_hash
+
+    site_state['backups'] = sorted(replicated_backups)
+    save_replication_state(replication_state)
+    if errors:
+        err_string = f'Replication of site {site_name} to {replication_target["name"]} failed for: ' + \
+            '; '.join(errors)
+        logging.error(err_string)
+        raise Exception(err_string)
+    logging.info(f'Completed replication of site {site_name} to {replication_target["name"]}')
+
+
+def replicate_file(replication_target, local_path, relative_path):
+    if replication_target['kind'] == 'dir':
+        target_file_path = replication_target['path'] + '/' + relative_path
+        os.makedirs(os.path.dirname(target_file_path), exist_ok=True)
+        shutil.copyfile(local_path, target_file_path + '.tmp')
+        os.replace(target_file_path + '.tmp', target_file_path)
+    elif replication_target['kind'] == 'ssh':
+        target_file_path = replication_target['path'] + '/' + relative_path
+        mkdir_string = 'mkdir -p ' + shlex.quote(os.path.dirname(target_file_path))
+        logging.debug(f"Executing this command over SSH: '{mkdir_string}'")
+        ssh(get_replication_site_data(replication_target), mkdir_string, f'Creating directory for {relative_path}')
+        rsync_string = '/usr/bin/rsync --protect-args --partial --info=progress2 -ai -e ' + \
+            shlex.quote('ssh -p ' + str(replication_target['port'])) + ' ' + shlex.quote(local_path) + ' ' + \
+            shlex.quote(replication_target['username'] + '@' + replication_target['hostname'] + ':' + \
+            target_file_path)
+        logging.debug(f'Executing: {rsync_string}')
+        run_rsync(rsync_string, f'replication of {relative_path}')
+    else:
+        replication_target['client'].upload_file(local_path, replication_target['bucket'],
+            get_replication_key(replication_target, relative_path), Config=replication_target['transfer_config'])
+
+
+def replicate_delete(replication_target, relative_path):
+    if replication_target['kind'] == 'dir':
+        target_file_path = replication_target['path'] + '/' + relative_path
+        if os.path.isfile(target_file_path):
+            os.remove(target_file_path)
+    elif replication_target['kind'] == 'ssh':
+        rm_string = 'rm -f ' + shlex.quote(replication_target['path'] + '/' + relative_path)
+        logging.debug(f"Executing this command over SSH: '{rm_string}'")
+        ssh(get_replication_site_data(replication_target), rm_string, f'Deleting replica of {relative_path}')
+    else:
+        replication_target['client'].delete_object(Bucket=replication_target['bucket'],
+            Key=get_replication_key(replication_target, relative_path))
+
+
+# Returns an ssh replication target in the form ssh() takes site data
+def get_replication_site_data(replication_target):
+    return { 'ssh_hostname': replication_target['hostname'], 'ssh_port': replication_target['port'],
+             'ssh_username': replication_target['username'] }
+
+
+def get_replication_key(replication_target, relative_path):
+    if replication_target['prefix']:
+        return replication_target['prefix'] + '/' + relative_path
+    return relative_path
+
+
+def get_replication_state():
+    replication_state_filename = g.backups_dir_path + '/replication_state.json'
+    if os.path.isfile(replication_state_filename):
+        with open(replication_state_filename) as replication_state_file:
+            return json.load(replication_state_file)
+    return {}
+
+
+def save_replication_state(replication_state):
+    replication_state_filename = g.backups_dir_path + '/replication_state.json'
+    json.dump(replication_state, open(replication_state_filename + '.tmp', 'w'))
+    os.replace(replication_state_filename + '.tmp', replication_state_filename)
+
+
+# Tests SSH connectivity to all sites concurrently, logs a table of results and returns dict of site name -> result
+def run_ssh_tests(sites_data):
+    global g
+    ssh_test_results = {}
+    if not sites_data:
+        return ssh_test_results
+    logging.info(f'Testing SSH connection to {len(sites_data)} sites')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(SSH_TEST_MAX_WORKERS, len(sites_data))) as executor:
+        futures = { executor.submit(ssh_test, x, sites_data[x]): x for x in sites_data }
+        for future in concurrent.futures.as_completed(futures):
+            ssh_test_results[futures[future]] = future.result()
+
+    def format_ms(value):
+        return f'{value:.0f}' if value is not None else '-'
+    table_lines = [ f"{'Site':30} {'Result':7} {'Connect ms':>10} {'Host key':9} {'Auth':10} {'Command ms':>10} Error" ]
+    for site_name in sites_data:
+        result = ssh_test_results[site_name]
+        table_lines.append(f"{site_name:30} {'OK' if result['ok'] else 'FAILED':7} " \
+            f"{format_ms(result['connect_ms']):>10} {result['host_key'] or '-':9} {result['auth_method'] or '-':10} " \
+            f"{format_ms(result['command_ms']):>10} {result['error'] or ''}")
+        if not result['ok']:
+            g.ssh_test_failure = True
+    logging.info('SSH test results:\n' + '\n'.join(table_lines))
+    return ssh_test_results
+
 
 def ssh_test(site_name, site_data):
-    logging.info(f'Testing SSH connection to site {site_name}')
+    result = { 'ok': False, 'connect_ms': None, 'host_key': None, 'auth_method': None, 'command_ms': None,
+               'error': None }
     client = paramiko.SSHClient()
     client.load_system_host_keys()
+    sock = None
     try:
-        client.connect(site_data['ssh_hostname'], username=site_data['ssh_username'], port=int(site_data['ssh_port']))
-        msg = [stdin, stdout, stderr] = client.exec_command('ls')
-    except:
-        logging.info(f'SSH test *** FAILED *** for site {site_name}!')
-        g.ssh_test_failure = True
-        return
-    logging.info(f'SSH test succeeded for site {site_name}!')
+        # Open the TCP connection separately so its latency can be reported apart from SSH handshake and auth
+        start_time = time.perf_counter()
+        sock = socket.create_connection((site_data['ssh_hostname'], int(site_data['ssh_port'])),
+            timeout=SSH_CONNECT_TIMEOUT)
+        result['connect_ms'] = (time.perf_counter() - start_time) * 1000
+        client.connect(site_data['ssh_hostname'], username=site_data['ssh_username'], port=int(site_data['ssh_port']),
+            sock=sock, timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_AUTH_TIMEOUT, auth_timeout=SSH_AUTH_TIMEOUT)
+        result['host_key'] = 'known'
+        auth_handler = client.get_transport().auth_handler
+        result['auth_method'] = getattr(auth_handler, 'auth_method', None)
+        start_time = time.perf_counter()
+        [stdin, stdout, stderr] = client.exec_command('true', timeout=SSH_COMMAND_TIMEOUT)
+        stdout.read()
+        exit_status = stdout.channel.recv_exit_status()
+        result['command_ms'] = (time.perf_counter() - start_time) * 1000
+        if exit_status != 0:
+            result['error'] = f'remote command exited with status {exit_status}'
+        else:
+            result['ok'] = True
+    except paramiko.BadHostKeyException as e:
+        result['host_key'] = 'MISMATCH'
+        result['error'] = str(e)
+    except paramiko.SSHException as e:
+        if 'known_hosts' in str(e):
+            result['host_key'] = 'unknown'
+        result['error'] = str(e) or type(e).__name__
+    except (OSError, socket.timeout) as e:
+        result['error'] = str(e) or type(e).__name__
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    finally:
+        client.close()
+        # client.close() only closes the socket through a transport that got going, so close it here as well
+        if sock is not None:
+            sock.close()
+    if not result['ok']:
+        logging.debug(f"SSH test failed for site {site_name}: {result['error']}")
+    return result
 
 
 def do_backup(site_name, site_data, existing_backups=None):
@@ -561,18 +1757,34 @@ def do_backup(site_name, site_data, existing_backups=None):
     file_handler.setLevel(logging.DEBUG) # Into log files, write everything including DEBUG messages
     file_handler.setFormatter(logging_formatter)
     root_logger.addHandler(file_handler)
-    
-    logging.info(f'Starting backup for {site_name}')
-    if site_data['do_mysql_backup']:
-        dump_db(site_name, site_data)
-    retrieve_html_files(site_name, site_data, existing_backups)
-
-    logging.info(f'Completed backup for {site_name} in ' \
-                  f"{g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string}")
 
-    # Shutdown and remove per-backup logging handler
-    file_handler.close()
-    logging.getLogger().removeHandler(file_handler)
+    try:
+        logging.info(f'Starting backup for {site_name}')
+        backup_start = time.monotonic()
+        if site_data['do_mysql_backup']:
+            dump_db(site_name, site_data)
+        transfer = retrieve_html_files(site_name, site_data, existing_backups)
+        changes = write_backup_manifest(site_name, existing_backups)
+        if transfer is not None:
+            transfer['backup_seconds'] = time.monotonic() - backup_start
+        record_transfer_history(site_name, transfer, changes)
+
+        logging.info(f'Completed backup for {site_name} in ' \
+                      f"{g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string}")
+    except BackupCancelled as e:
+        # Leave no partial backup behind (it was never added to the tracker)
+        file_handler.close()
+        logging.getLogger().removeHandler(file_handler)
+        shutil.rmtree(g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string)
+        logging.warning(f'Cancelled backup of site {site_name} ({e}) and removed its partial files')
+        if isinstance(e, LeaseLost):
+            raise
+        return False
+    finally:
+        # Shutdown and remove per-backup logging handler
+        file_handler.close()
+        logging.getLogger().removeHandler(file_handler)
+    return True
 
 
 def do_work(work_to_do, site_name, site_data):
@@ -622,90 +1834,834 @@ def retrieve_html_files(site_name, site_data, existing_backups):
     assert(os.path.isdir(html_files_dir))
     # Seed the target /files directory with files from the last backup to drastically reduce rsync
     # retrieval data and time
-    first_rsync = True
+    seed_backup = None
     if existing_backups is not None and len(existing_backups) > 1:
-        last_backup = existing_backups[-1][1]
-        if not is_zip_file(last_backup):
-            last_backup_path = g.backups_dir_path + '/' + site_name + '/' + last_backup + '/files'
-            copy_string = 'cp -r ' + last_backup_path + '/* ' + html_files_dir
-            logging.info(f'Copying files from {last_backup_path} to {html_files_dir} to accelerate rsync ' \
-                          '(can take a while for large sites)')
-            try:
-                exec_output = subprocess.check_output(copy_string, stderr=subprocess.STDOUT, shell=True)
-            except subprocess.CalledProcessError as e:
-                err_string = 'cp exited with error status ' + str(e.returncode) + ' and error: ' + e.output
-                logging.error(err_string)
-                raise Exception(err_string)
-            first_rsync = False
+        if not is_archive_file(existing_backups[-1][1]):
+            seed_backup = existing_backups[-1][1]
+    transfer_strategy = select_transfer_strategy(site_name, site_data, seed_backup is not None)
+    transfer_start = time.monotonic()
+    if transfer_strategy == 'tar':
+        retrieve_html_files_tar(site_name, site_data, html_files_dir)
+        return { 'strategy': 'tar', 'seeded': False, 'seconds': time.monotonic() - transfer_start }
+
+    first_rsync = True
+    if seed_backup is not None:
+        last_backup = seed_backup
+        last_backup_path = g.backups_dir_path + '/' + site_name + '/' + last_backup + '/files'
+        # Preserve timestamps (-a) so rsync's quick check skips unchanged files, and on copy-on-write filesystems
+        # (btrfs, XFS) clone extents rather than copying data
+        seeding_strategy = get_seeding_strategy()
+        copy_string = 'cp -a ' + ('--reflink=always ' if seeding_strategy == 'reflink' else '') + \
+            last_backup_path + '/* ' + html_files_dir
+        logging.info(f'Copying files from {last_backup_path} to {html_files_dir} to accelerate rsync using ' \
+                      f'{seeding_strategy} seeding (can take a while for large sites)')
+        logging.debug(f'Executing: {copy_string}')
+        seeding_start = time.monotonic()
+        try:
+            with timed_span('seed copy', is_subprocess=True):
+                exec_output = run_command(copy_string, f'seed copy of site {site_name}')
+        except subprocess.CalledProcessError as e:
+            err_string = 'cp exited with error status ' + str(e.returncode) + ' and error: ' + str(e.output)
+            logging.error(err_string)
+            raise Exception(err_string)
+        logging.info(f'Seeded files for site {site_name} from backup {last_backup} using {seeding_strategy} ' \
+                     f'seeding in {time.monotonic() - seeding_start:.1f} seconds')
+        first_rsync = False
     log_string = f'Starting HTML file retrieval using rsync for site {site_name} to {html_files_dir}'
     if first_rsync:
         log_string += ' (can take a while since this is first rsync retrieval)'
     logging.info(log_string)
-    rsync_string = '/usr/bin/rsync --append --delete -aviz -e "ssh -p ' + str(site_data['ssh_port']) + '" "' + \
-        str(site_data['ssh_username']) + '@' + site_data['ssh_hostname'] + ':/home/' + site_data['ssh_username'] + \
-        '/www/' + site_data['site_hostname'] + '/public_html/*" "' + html_files_dir + '"'
+    rsync_streams = int(site_data.get('rsync_streams', 1))
+    if rsync_streams > 1:
+        previous_backup = existing_backups[-1][1] if existing_backups else None
+        with timed_span('rsync files', is_subprocess=True):
+            retrieve_html_files_sharded(site_name, site_data, html_files_dir, rsync_streams, previous_backup)
+        # Excluded top-level entries named as shard sources are skipped by rsync but not removed from the seed
+        if get_filters(site_name, site_data):
+            prune_excluded_files(html_files_dir, get_filters(site_name, site_data))
+        logging.info(f'Completed HTML file using rsync retrieval for site {site_name} to {html_files_dir}')
+        return { 'strategy': 'rsync', 'seeded': not first_rsync, 'seconds': time.monotonic() - transfer_start }
+    rsync_string = '/usr/bin/rsync --append --delete --info=progress2 -aviz' + \
+        get_rsync_filter_args(get_filters(site_name, site_data)) + ' -e "ssh -p ' + \
+        str(site_data['ssh_port']) + '" "' + str(site_data['ssh_username']) + '@' + site_data['ssh_hostname'] + \
+        ':/home/' + site_data['ssh_username'] + '/www/' + site_data['site_hostname'] + '/public_html/*" "' + \
+        html_files_dir + '"'
     logging.debug(f'Executing: {rsync_string}')
     try:
-        exec_output = subprocess.check_output(rsync_string, stderr=subprocess.STDOUT, shell=True)
+        with timed_span('rsync files', is_subprocess=True):
+            run_rsync(rsync_string, f'files of site {site_name}')
     except subprocess.CalledProcessError as e:
         rsync_err_string = 'rsync exited with error status ' + str(e.returncode) + ' and error: ' + str(e.output)
         logging.error(rsync_err_string)
         raise Exception(rsync_err_string)
     logging.info(f'Completed HTML file using rsync retrieval for site {site_name} to {html_files_dir}')
+    return { 'strategy': 'rsync', 'seeded': not first_rsync, 'seconds': time.monotonic() - transfer_start }
+
+
+# Returns a site's 'filters' setting from vault.yml as { 'include': [...], 'exclude': [...] }, or None if it has none.
+# Patterns follow rsync conventions relative to public_html: a leading '/' anchors a pattern to public_html, a trailing
+# '/' matches only directories, patterns without '/' match a file or directory name at any depth, and include
+# patterns take precedence over exclude patterns.
+def get_filters(site_name, site_data):
+    if 'filters' not in site_data or not site_data['filters']:
+        return None
+    filters = { 'include': [], 'exclude': [] }
+    for filter_type in site_data['filters']:
+        if filter_type not in filters:
+            err_string = f"Filter type '{filter_type}' for site {site_name} must be 'include' or 'exclude'"
+            logging.error(err_string)
+            raise Exception(err_string)
+        filters[filter_type] = [ str(x) for x in site_data['filters'][filter_type] ]
+    return filters
+
+
+def get_rsync_filter_args(filters):
+    if not filters:
+        return ''
+    # --delete-excluded also drops excluded files carried over from the seeding backup
+    return ''.join(' --include=' + shlex.quote(x) for x in filters['include']) + \
+        ''.join(' --exclude=' + shlex.quote(x) for x in filters['exclude']) + ' --delete-excluded'
+
+
+def matches_filter_pattern(relative_path, is_dir, pattern):
+    if pattern.endswith('/'):
+        if not is_dir:
+            return False
+        pattern = pattern.rstrip('/')
+    if pattern.startswith('/'):
+        return fnmatch.fnmatchcase(relative_path, pattern[1:])
+    if '/' not in pattern:
+        return fnmatch.fnmatchcase(os.path.basename(relative_path), pattern)
+    path_parts = relative_path.split('/')
+    return any(fnmatch.fnmatchcase('/'.join(path_parts[x:]), pattern) for x in range(len(path_parts)))
+
+
+def is_excluded(relative_path, is_dir, filters):
+    if any(matches_filter_pattern(relative_path, is_dir, x) for x in filters['include']):
+        return False
+    return any(matches_filter_pattern(relative_path, is_dir, x) for x in filters['exclude'])
+
+
+# Removes files and directories excluded by a site's filters from a retrieved files tree.  Returns number removed.
+def prune_excluded_files(html_files_dir, filters):
+    removed_count = 0
+    for dir_path, dir_names, file_names in os.walk(html_files_dir):
+        relative_dir_path = os.path.relpath(dir_path, html_files_dir)
+        relative_dir_path = '' if relative_dir_path == '.' else relative_dir_path + '/'
+        for dir_name in list(dir_names):
+            if is_excluded(relative_dir_path + dir_name, True, filters):
+                logging.debug(f'Removing excluded directory {dir_path}/{dir_name}')
+                if os.path.islink(dir_path + '/' + dir_name):
+                    os.remove(dir_path + '/' + dir_name)
+                else:
+                    shutil.rmtree(dir_path + '/' + dir_name)
+                dir_names.remove(dir_name)
+                removed_count += 1
+        for file_name in file_names:
+            if is_excluded(relative_dir_path + file_name, False, filters):
+                logging.debug(f'Removing excluded file {dir_path}/{file_name}')
+                os.remove(dir_path + '/' + file_name)
+                removed_count += 1
+    return removed_count
+
+
+# Ranks directories of a site by bytes in added or modified files and number of changed files across its most recent
+# backups, using manifests so no backup needs unpacking
+def analyze_transfers_for_site(site_name, site_data):
+    existing_backups = get_existing_backups(site_name)
+    backups_with_manifest = []
+    for existing_backup in reversed(existing_backups):
+        with open_manifest(site_name, existing_backup[1]) as manifest_file:
+            if manifest_file is not None:
+                backups_with_manifest.insert(0, existing_backup[1])
+        if len(backups_with_manifest) == ANALYSIS_BACKUPS:
+            break
+    print(f'Site: {site_name}')
+    if len(backups_with_manifest) < 2:
+        print(f'Fewer than two backups with a {MANIFEST_FILE_NAME} to analyze')
+        return
+
+    directory_stats = {}
+    def get_directory_stats(path):
+        path_parts = os.fsdecode(path).split('/')[1:-1][:ANALYSIS_DIRECTORY_DEPTH]
+        return [ directory_stats.setdefault('/'.join(path_parts[:x]), { 'bytes_changed': 0, 'files_changed': 0,
+            'size': 0 }) for x in range(1, len(path_parts) + 1) ]
+
+    for (old_backup, new_backup) in zip(backups_with_manifest[:-1], backups_with_manifest[1:]):
+        with open_manifest(site_name, old_backup) as old_manifest_file, \
+             open_manifest(site_name, new_backup) as new_manifest_file:
+            for (change, path, old_record, new_record) in diff_manifests(read_manifest(old_manifest_file),
+                                                                         read_manifest(new_manifest_file)):
+                if not path.startswith(b'files/'):
+                    continue
+                for stats in get_directory_stats(path):
+                    stats['files_changed'] += 1
+                    if new_record is not None:
+                        stats['bytes_changed'] += new_record[1]
+    with open_manifest(site_name, backups_with_manifest[-1]) as manifest_file:
+        for (path, size, mtime_ns, digest) in read_manifest(manifest_file):
+            if path.startswith(b'files/'):
+                for stats in get_directory_stats(path):
+                    stats['size'] += size
+
+    filters = get_filters(site_name, site_data)
+    print(f'Changes across {len(backups_with_manifest)} backups from {backups_with_manifest[0]} to ' \
+          f'{backups_with_manifest[-1]}, top 25 directories by bytes in added or modified files:')
+    print(f"{'Directory':60} {'Bytes changed':>15} {'Files changed':>14} {'Current size':>15} Excluded")
+    for (directory, stats) in sorted(directory_stats.items(), key=lambda x: -x[1]['bytes_changed'])[:25]:
+        excluded = 'yes' if filters and is_excluded(directory, True, filters) else ''
+        print(f"{directory:60} {stats['bytes_changed']:15,} {stats['files_changed']:14,} {stats['size']:15,} " \
+              f"{excluded}")
+
+
+# Chooses between rsync and a bulk tar stream over SSH for retrieving a site's files.  A tar stream avoids rsync's
+# per-file protocol overhead, which dominates for trees of many small files when there is no seed to rsync against
+# (cold start) or when most files changed since the last backup (high churn).  Throughput history of the site (bytes
+# of the complete tree per second) decides, and tar is tried when there is no history for it yet.
+def select_transfer_strategy(site_name, site_data, seeded):
+    if 'transfer_strategy' in site_data:
+        if site_data['transfer_strategy'] not in ('rsync', 'tar'):
+            err_string = f"transfer_strategy for site {site_name} must be 'rsync' or 'tar', not " \
+                f"'{site_data['transfer_strategy']}'"
+            logging.error(err_string)
+            raise Exception(err_string)
+        return site_data['transfer_strategy']
+    if shutil.which('zstd') is None:
+        return 'rsync'
+
+    transfer_history = get_transfer_history(site_name)
+    if seeded:
+        last_churn = transfer_history[-1].get('churn') if transfer_history else None
+        if last_churn is None or last_churn < TAR_CHURN_THRESHOLD:
+            return 'rsync'
+    rsync_throughput = get_throughput(transfer_history, 'rsync', seeded)
+    tar_throughput = get_throughput(transfer_history, 'tar', False)
+    if tar_throughput is not None and rsync_throughput is not None and rsync_throughput > tar_throughput:
+        return 'rsync'
+    logging.info(f"Using tar stream for site {site_name} since " + \
+        (f'{last_churn:.0%} of files changed in last backup' if seeded else 'there is no backup to seed rsync from'))
+    return 'tar'
+
+
+def get_throughput(transfer_history, strategy, seeded):
+    matching = [ x for x in transfer_history if x['strategy'] == strategy and x['seeded'] == seeded and
+                 x['seconds'] > 0 and x.get('bytes') ]
+    if not matching:
+        return None
+    return sum(x['bytes'] for x in matching) / sum(x['seconds'] for x in matching)
+
+
+def get_transfer_history(site_name):
+    transfer_history_filename = g.backups_dir_path + '/' + site_name + '/transfer_history.json'
+    if os.path.isfile(transfer_history_filename):
+        with open(transfer_history_filename) as transfer_history_file:
+            return json.load(transfer_history_file)
+    return []
+
+
+# Appends this backup's transfer (strategy, seconds, size of tree and churn from the manifest) to the site's history
+def record_transfer_history(site_name, transfer, changes):
+    if transfer is None:
+        return
+    (file_count, byte_count) = get_manifest_totals(site_name, g.datetime_start_string)
+    transfer['backup'] = g.datetime_start_string
+    transfer['bytes'] = byte_count
+    if changes is not None and file_count > 0:
+        transfer['churn'] = (changes['added'] + changes['modified']) / file_count
+    transfer_history = (get_transfer_history(site_name) + [ transfer ])[-TRANSFER_HISTORY_LENGTH:]
+    transfer_history_filename = g.backups_dir_path + '/' + site_name + '/transfer_history.json'
+    json.dump(transfer_history, open(transfer_history_filename + '.tmp', 'w'))
+    os.replace(transfer_history_filename + '.tmp', transfer_history_filename)
+
+
+# Returns (number of files, total bytes) under files/ as recorded in a backup's manifest
+def get_manifest_totals(site_name, backup_name):
+    file_count = 0
+    byte_count = 0
+    with open_manifest(site_name, backup_name) as manifest_file:
+        if manifest_file is None:
+            return (file_count, byte_count)
+        for (path, size, mtime_ns, digest) in read_manifest(manifest_file):
+            if path.startswith(b'files/'):
+                file_count += 1
+                byte_count += size
+    return (file_count, byte_count)
+
+
+# Translates the exclude patterns that mean the same to GNU tar as to rsync into tar arguments: a name pattern without
+# '/' (matched against each path component by unanchored tar) and a pattern anchored with a leading '/' (matched from
+# public_html with --anchored).  Directory-only patterns (trailing '/') and unanchored patterns with '/' inside have
+# no tar equivalent and are left to prune_excluded_files.
+def get_tar_exclude_args(exclude_patterns):
+    name_patterns = [ x for x in exclude_patterns if '/' not in x ]
+    anchored_patterns = [ x[1:] for x in exclude_patterns if x.startswith('/') and not x.endswith('/') ]
+    if not name_patterns and not anchored_patterns:
+        return ''
+    return ' --no-wildcards-match-slash' + \
+        ''.join(' --exclude=' + shlex.quote(x) for x in name_patterns) + \
+        (' --anchored' + ''.join(' --exclude=' + shlex.quote(x) for x in anchored_patterns) + ' --no-anchored'
+         if anchored_patterns else '')
+
+
+# Pulls public_html as a single zstd-compressed tar stream over SSH and unpacks it as it arrives
+def retrieve_html_files_tar(site_name, site_data, html_files_dir):
+    public_html_path = '/home/' + site_data['ssh_username'] + '/www/' + site_data['site_hostname'] + '/public_html'
+    (exit_status, output) = ssh_command_output(site_data, 'command -v zstd')
+    remote_compressor = 'zstd -c -3 -T0' if exit_status == 0 else 'gzip -c -1'
+    local_decompressor = 'zstd -dc' if exit_status == 0 else 'gzip -dc'
+    # Like public_html/* for rsync, the remote glob leaves out top-level dot entries
+    # Exclusions are applied at the source to save transfer where possible, which is only safe without include rules
+    # (tar has no way to re-include).  Whatever tar cannot express is pruned locally after extraction.
+    filters = get_filters(site_name, site_data)
+    tar_exclude_args = ''
+    if filters and not filters['include']:
+        tar_exclude_args = get_tar_exclude_args(filters['exclude'])
+    remote_string = f'set -o pipefail; cd {shlex.quote(public_html_path)} && tar -cf -{tar_exclude_args} * | ' \
+        f'{remote_compressor}'
+    tar_string = 'set -o pipefail; ssh -p ' + str(site_data['ssh_port']) + ' ' + \
+        shlex.quote(str(site_data['ssh_username']) + '@' + site_data['ssh_hostname']) + ' ' + \
+        shlex.quote(remote_string) + ' | ' + local_decompressor + ' | tar -xf - -C ' + shlex.quote(html_files_dir)
+    logging.info(f'Starting HTML file retrieval using tar stream for site {site_name} to {html_files_dir}')
+    logging.debug(f'Executing: {tar_string}')
+    try:
+        with timed_span('tar stream', is_subprocess=True):
+            run_command(tar_string, f'tar stream of site {site_name}', executable='/bin/bash')
+    except subprocess.CalledProcessError as e:
+        tar_err_string = 'tar stream exited with error status ' + str(e.returncode) + ' and error: ' + e.output
+        logging.error(tar_err_string)
+        raise Exception(tar_err_string)
+    if filters:
+        prune_excluded_files(html_files_dir, filters)
+    logging.info(f'Completed HTML file using tar stream retrieval for site {site_name} to {html_files_dir}')
+
+
+# Retrieves public_html using several concurrent rsync streams, each over its own SSH connection, with the top-level
+# entries of public_html partitioned into shards of roughly equal size
+def retrieve_html_files_sharded(site_name, site_data, html_files_dir, rsync_streams, previous_backup):
+    public_html_path = '/home/' + site_data['ssh_username'] + '/www/' + site_data['site_hostname'] + '/public_html'
+    top_level_entries = list_remote_entries(site_data, public_html_path)
+
+    # Sources are named explicitly per shard, so --delete only prunes inside them.  Top-level entries no longer on
+    # the site (but carried over by seeding) have to be pruned here.  Like public_html/*, dot entries are left alone.
+    for local_entry in os.listdir(html_files_dir):
+        if local_entry.startswith('.') or local_entry in top_level_entries:
+            continue
+        local_entry_path = html_files_dir + '/' + local_entry
+        logging.debug(f'Deleting {local_entry_path} which no longer exists on site {site_name}')
+        if os.path.isdir(local_entry_path) and not os.path.islink(local_entry_path):
+            shutil.rmtree(local_entry_path)
+        else:
+            os.remove(local_entry_path)
+
+    if not top_level_entries:
+        logging.warning(f'No files found under {public_html_path} for site {site_name}')
+        return
+
+    entry_sizes = get_top_level_sizes(site_name, previous_backup)
+    shards = partition_entries(top_level_entries, entry_sizes, rsync_streams)
+    logging.info(f'Retrieving {len(top_level_entries)} top-level entries for site {site_name} using ' \
+                 f'{len(shards)} concurrent rsync streams')
+
+    rsync_strings = []
+    for shard in shards:
+        sources = [ shlex.quote(str(site_data['ssh_username']) + '@' + site_data['ssh_hostname'] + ':' + \
+            public_html_path + '/' + shard[0]) ]
+        sources += [ shlex.quote(':' + public_html_path + '/' + x) for x in shard[1:] ]
+        rsync_strings.append('/usr/bin/rsync --append --delete --protect-args --info=progress2 -aviz' + \
+            get_rsync_filter_args(get_filters(site_name, site_data)) + ' -e "ssh -p ' + \
+            str(site_data['ssh_port']) + '" ' + ' '.join(sources) + ' "' + html_files_dir + '"')
+
+    for shard_number, rsync_string in enumerate(rsync_strings):
+        logging.debug(f'Executing (stream {shard_number + 1}): {rsync_string}')
+    results = asyncio.run(gather_commands([ run_rsync_async(x, f'files of site {site_name} (stream {y + 1})')
+                                            for (y, x) in enumerate(rsync_strings) ]))
+    errors = []
+    for (shard_number, result) in enumerate(results):
+        if isinstance(result, subprocess.CalledProcessError):
+            errors.append(f'stream {shard_number + 1} ({", ".join(shards[shard_number])}) exited with error status ' \
+                f'{result.returncode} and error: {result.output}')
+        elif isinstance(result, BaseException):
+            raise result
+    if errors:
+        rsync_err_string = f'{len(errors)} of {len(shards)} rsync streams failed for site {site_name}: ' + \
+            '; '.join(errors)
+        logging.error(rsync_err_string)
+        raise Exception(rsync_err_string)
+
+
+def run_rsync(rsync_string, description):
+    return asyncio.run(run_rsync_async(rsync_string, description))
+
+
+# Runs rsync, parsing its output incrementally into counters and logging periodic progress, so memory stays flat
+# regardless of tree size.  Returns the counters.  Raises subprocess.CalledProcessError (with only the tail of the
+# output) if rsync fails.
+async def run_rsync_async(rsync_string, description):
+    metrics = { 'files': 0, 'deleted': 0, 'bytes': 0, 'percent': 0, 'speed': None, 'eta': None, 'total_size': None }
+    start_time = time.monotonic()
+    last_progress_time = start_time
+
+    def handle_line(line):
+        nonlocal last_progress_time
+        progress_match = RSYNC_PROGRESS_REGEX.match(line)
+        if progress_match:
+            metrics['bytes'] = int(progress_match.group(1).replace(',', ''))
+            metrics['percent'] = int(progress_match.group(2))
+            metrics['speed'] = progress_match.group(3)
+            metrics['eta'] = progress_match.group(4)
+        elif line.startswith('>f'):
+            metrics['files'] += 1
+        elif line.startswith('*deleting'):
+            metrics['deleted'] += 1
+        else:
+            total_size_match = RSYNC_TOTAL_SIZE_REGEX.match(line)
+            if total_size_match:
+                metrics['total_size'] = int(total_size_match.group(1).replace(',', ''))
+        if time.monotonic() - last_progress_time >= RSYNC_PROGRESS_SECONDS:
+            last_progress_time = time.monotonic()
+            logging.info(f"rsync progress for {description}: {metrics['files']:,} files, {metrics['bytes']:,} " \
+                f"bytes, {metrics['percent']}% at {metrics['speed']}, ETA {metrics['eta']}")
+        return progress_match is None
+
+    await run_command_async(rsync_string, description, line_handler=handle_line)
+    metrics['seconds'] = time.monotonic() - start_time
+    logging.info(f"rsync metrics for {description}: {metrics['files']:,} files transferred, " \
+        f"{metrics['deleted']:,} deleted, {metrics['bytes']:,} bytes in {metrics['seconds']:.1f} seconds" + \
+        (f", total size {metrics['total_size']:,} bytes" if metrics['total_size'] is not None else ''))
+    return metrics
+
+
+# Work on a backup stopped part-way, either at the deadline or because another node took over the site
+class BackupCancelled(Exception):
+    pass
+
+
+class DeadlineExceeded(BackupCancelled):
+    pass
+
+
+class LeaseLost(BackupCancelled):
+    pass
+
+
+# Returns seconds left before the --deadline of this run, or None if there is no deadline
+def get_remaining_seconds():
+    if g.deadline is None:
+        return None
+    return g.deadline - time.monotonic()
+
+
+# Orders sites for a run with a deadline: highest 'priority' (vault.yml, default 0) first, then shortest estimated
+# backup time, with sites without history last within their priority
+def order_sites_by_priority(sites_data):
+    def sort_key(site_name):
+        estimated_seconds = estimate_backup_seconds(site_name)
+        return (-int(sites_data[site_name].get('priority', 0)), estimated_seconds is None, estimated_seconds or 0)
+    return sorted(sites_data, key=sort_key)
+
+
+# Estimates how long a backup of a site takes from the median of its recent backups, or None without history
+def estimate_backup_seconds(site_name):
+    backup_seconds = [ x['backup_seconds'] for x in get_transfer_history(site_name) if 'backup_seconds' in x ][-5:]
+    if not backup_seconds:
+        return None
+    return statistics.median(backup_seconds)
+
+
+###################################################################################################################
+# Asynchronous I/O layer.  External commands (rsync, tar, cp, du) and remote commands (through the OpenSSH client,
+# like rsync) run as asyncio subprocesses, so one thread can drive many of them at once, each with its own timeout
+# and the run's --deadline.  Synchronous callers use run_command(), run_rsync(), ssh() and ssh_command_output(),
+# which run a private event loop.
+###################################################################################################################
+
+# Runs a shell command in its own process group and returns its output, keeping only lines line_handler (if given)
+# returns True for and only the last RSYNC_ERROR_TAIL_LINES of those, or without line_handler the last
+# COMMAND_OUTPUT_MAX_LINES lines (only the last RSYNC_ERROR_TAIL_LINES lines are reported if it fails).  Raises
+# subprocess.CalledProcessError if it exits with an error, subprocess.TimeoutExpired if it runs past timeout seconds,
+# DeadlineExceeded if it runs past the deadline and LeaseLost if the lease of the site being worked on is lost.  The
+# whole process group (e.g. ssh under rsync) is terminated on timeout or cancellation.  With separate_stderr, only
+# standard output is returned (for commands whose output is parsed) and the tail of standard error is kept apart, as
+# the stderr attribute of the exception if the command fails.  Commands that are not cancellable (cleanup after a
+# cancellation) are only subject to their timeout.
+async def run_command_async(command_string, description, timeout=None, line_handler=None, input_bytes=None,
+                            executable=None, separate_stderr=False, cancellable=True):
+    if cancellable:
+        check_lease_lost(description)
+    remaining_seconds = get_remaining_seconds() if cancellable else None
+    time_limit = min([ x for x in (timeout, remaining_seconds) if x is not None ], default=None)
+    process = await asyncio.create_subprocess_shell(command_string,
+        stdin=subprocess.DEVNULL if input_bytes is None else subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE if separate_stderr else subprocess.STDOUT, start_new_session=True,
+        executable=executable)
+    if cancellable:
+        with g.running_processes_lock:
+            g.running_processes.add(process)
+    output_lines = collections.deque(
+        maxlen=COMMAND_OUTPUT_MAX_LINES if line_handler is None else RSYNC_ERROR_TAIL_LINES)
+    error_lines = collections.deque(maxlen=RSYNC_ERROR_TAIL_LINES)
+
+    async def read_output():
+        async for line in read_output_lines(process.stdout):
+            if line_handler is None or line_handler(line):
+                output_lines.append(line)
+
+    async def read_errors():
+        async for line in read_output_lines(process.stderr):
+            error_lines.append(line)
+
+    async def communicate():
+        if input_bytes is not None:
+            # A command that exits without reading all its input (e.g. ssh failing to connect) is judged by its exit
+            # status
+            with contextlib.suppress(BrokenPipeError, ConnectionResetError):
+                process.stdin.write(input_bytes)
+                await process.stdin.drain()
+                process.stdin.close()
+        await asyncio.gather(read_output(), *([ read_errors() ] if separate_stderr else []))
+        return await process.wait()
+
+    try:
+        returncode = await asyncio.wait_for(communicate(), None if time_limit is None else max(time_limit, 0))
+    except asyncio.TimeoutError:
+        if remaining_seconds is not None and get_remaining_seconds() <= 0:
+            raise DeadlineExceeded(f'{description} cancelled')
+        raise subprocess.TimeoutExpired(command_string, timeout,
+            output='\n'.join(list(output_lines)[-RSYNC_ERROR_TAIL_LINES:]), stderr='\n'.join(error_lines))
+    finally:
+        if process.returncode is None:
+            terminate_process_group(process)
+            await process.wait()
+        with g.running_processes_lock:
+            g.running_processes.discard(process)
+    if cancellable:
+        check_lease_lost(description)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command_string,
+            output='\n'.join(list(output_lines)[-RSYNC_ERROR_TAIL_LINES:]), stderr='\n'.join(error_lines))
+    return '\n'.join(output_lines)
+
+
+def run_command(command_string, description, timeout=None, executable=None, cancellable=True):
+    return asyncio.run(run_command_async(command_string, description, timeout, executable=executable,
+        cancellable=cancellable))
+
+
+# Runs coroutines concurrently and returns their results, with exceptions returned in place of results
+async def gather_commands(coroutines):
+    return await asyncio.gather(*coroutines, return_exceptions=True)
+
+
+# Raises LeaseLost if the lease of the site being worked on was lost (its running commands are then terminated)
+def check_lease_lost(description):
+    site_lease = g.site_leases.get(g.current_site)
+    if site_lease is not None and site_lease.lost:
+        raise LeaseLost(f'{description} cancelled since the site lease was lost')
+
+
+def terminate_running_commands():
+    with g.running_processes_lock:
+        running_processes = list(g.running_processes)
+    for process in running_processes:
+        terminate_process_group(process)
+
+
+def terminate_process_group(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+# Generates decoded lines from a subprocess output stream as they arrive, splitting on carriage returns as well as
+# newlines (progress lines are rewritten in place using carriage returns).  Overlong lines are cut to keep memory
+# bounded.
+async def read_output_lines(stream):
+    pending = b''
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        pending += chunk
+        lines = re.split(rb'[\r\n]', pending)
+        pending = lines.pop()[-65536:]
+        for line in lines:
+            if line:
+                yield line.decode('utf-8', 'replace')
+    if pending:
+        yield pending.decode('utf-8', 'replace')
+
+
+# Runs a command on a site with the OpenSSH client and returns its output.  The command is passed to the remote shell
+# on standard input, which keeps it (and secrets in it, like the database password) out of local process listings.
+# With check=False, returns (exit status, output) instead of raising subprocess.CalledProcessError.
+async def ssh_async(site_data, command_string, description, timeout=SSH_QUICK_COMMAND_TIMEOUT, check=True,
+                    separate_stderr=False, cancellable=True):
+    ssh_string = 'ssh -p ' + str(site_data['ssh_port']) + ' -o BatchMode=yes -o ConnectTimeout=' + \
+        str(SSH_CONNECT_TIMEOUT) + ' ' + shlex.quote(str(site_data['ssh_username']) + '@' + \
+        site_data['ssh_hostname']) + ' sh'
+    if check:
+        return await run_command_async(ssh_string, description, timeout, input_bytes=command_string.encode(),
+            separate_stderr=separate_stderr, cancellable=cancellable)
+    try:
+        return (0, await run_command_async(ssh_string, description, timeout, input_bytes=command_string.encode(),
+            separate_stderr=separate_stderr, cancellable=cancellable))
+    except subprocess.CalledProcessError as e:
+        return (e.returncode, e.stderr if separate_stderr else e.output)
+
+
+# Runs a command on a site over SSH and returns its output, raising if it fails or times out
+def ssh(site_data, command_string, description, timeout=SSH_QUICK_COMMAND_TIMEOUT, cancellable=True):
+    try:
+        return asyncio.run(ssh_async(site_data, command_string, description, timeout, cancellable=cancellable))
+    except subprocess.CalledProcessError as e:
+        err_string = f'{description} exited with error status {e.returncode} and error: {e.output}'
+    except subprocess.TimeoutExpired as e:
+        err_string = f'{description} timed out after {e.timeout} seconds'
+    logging.error(err_string)
+    raise Exception(err_string)
+
+
+# Runs a command on a site over SSH and returns (exit status, stdout), or (exit status, stderr) if it failed.  Output
+# is kept apart from SSH client warnings, banners and shell noise on stderr, so it can be parsed.
+def ssh_command_output(site_data, command_string, timeout=SSH_QUICK_COMMAND_TIMEOUT):
+    logging.debug(f"Executing this command over SSH: '{command_string}'")
+    try:
+        return asyncio.run(ssh_async(site_data, command_string, command_string, timeout, check=False,
+            separate_stderr=True))
+    except subprocess.TimeoutExpired as e:
+        err_string = f"'{command_string}' over SSH timed out after {e.timeout} seconds"
+        logging.error(err_string)
+        raise Exception(err_string)
+
+
+# Runs a trivial command on all sites at once and returns a dict of site name -> error (None if it succeeded)
+async def ssh_preflight_async(sites_data):
+    semaphore = asyncio.Semaphore(SSH_TEST_MAX_WORKERS)
+
+    async def preflight(site_name):
+        async with semaphore:
+            try:
+                await ssh_async(sites_data[site_name], 'true', f'SSH pre-flight of site {site_name}',
+                    SSH_CONNECT_TIMEOUT + SSH_COMMAND_TIMEOUT)
+            except subprocess.CalledProcessError as e:
+                return f'exit status {e.returncode}: {e.output}'
+            except subprocess.TimeoutExpired as e:
+                return f'timed out after {e.timeout} seconds'
+            except BackupCancelled:
+                raise
+            except Exception as e:
+                return f'{type(e).__name__}: {e}'
+            return None
+
+    return dict(zip(sites_data, await asyncio.gather(*[ preflight(x) for x in sites_data ])))
+
+
+def list_remote_entries(site_data, remote_path):
+    (exit_status, output) = ssh_command_output(site_data, f'ls -1 {shlex.quote(remote_path)}')
+    if exit_status != 0:
+        err_string = f"Listing '{remote_path}' over SSH failed: {output}"
+        logging.error(err_string)
+        raise Exception(err_string)
+    return [ x for x in output.split('\n') if x ]
+
+
+# Returns a dict of top-level public_html entry name -> bytes, as recorded in the manifest of a previous backup
+def get_top_level_sizes(site_name, backup_name):
+    entry_sizes = {}
+    with open_manifest(site_name, backup_name) as manifest_file:
+        if manifest_file is None:
+            return entry_sizes
+        for (path, size, mtime_ns, digest) in read_manifest(manifest_file):
+            path_parts = os.fsdecode(path).split('/')
+            if len(path_parts) > 1 and path_parts[0] == 'files':
+                entry_sizes[path_parts[1]] = entry_sizes.get(path_parts[1], 0) + size
+    return entry_sizes
+
+
+# Greedily assigns entries, largest first, to whichever shard is currently smallest.  Entries without size history
+# are assumed to be of average size.
+def partition_entries(entries, entry_sizes, shard_count):
+    known_sizes = [ entry_sizes[x] for x in entries if x in entry_sizes ]
+    default_size = sum(known_sizes) // len(known_sizes) if known_sizes else 1
+    shard_heap = [ (0, x, []) for x in range(min(shard_count, len(entries))) ]
+    for entry in sorted(entries, key=lambda x: entry_sizes.get(x, default_size), reverse=True):
+        (shard_size, shard_number, shard) = heapq.heappop(shard_heap)
+        shard.append(entry)
+        heapq.heappush(shard_heap, (shard_size + entry_sizes.get(entry, default_size), shard_number, shard))
+    return [ x[2] for x in sorted(shard_heap, key=lambda x: x[1]) ]
+
+
+# Returns 'reflink' if the backups directory is on a filesystem supporting copy-on-write clones (btrfs, XFS with
+# reflink=1), else 'copy'.  Probed once per run.
+def get_seeding_strategy():
+    global g
+    if g.seeding_strategy is None:
+        probe_path = g.backups_dir_path + '/.reflink_probe'
+        Path(probe_path).write_bytes(b'reflink probe')
+        probe_string = f'cp --reflink=always "{probe_path}" "{probe_path}.clone"'
+        logging.debug(f'Executing: {probe_string}')
+        try:
+            run_command(probe_string, 'reflink probe')
+            g.seeding_strategy = 'reflink'
+        except subprocess.CalledProcessError as e:
+            logging.debug(f'Filesystem under {g.backups_dir_path} does not support reflinks: {str(e.output)}')
+            g.seeding_strategy = 'copy'
+        finally:
+            for path in [ probe_path, probe_path + '.clone' ]:
+                if os.path.isfile(path):
+                    os.remove(path)
+        logging.info(f'Using {g.seeding_strategy} seeding of new backups from previous backups')
+    return g.seeding_strategy
 
 
 def dump_db(site_name, site_data):
     global g
 
     logging.info(f'Starting database dump for site {site_name}')
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.connect(site_data['ssh_hostname'], username=site_data['ssh_username'], port=int(site_data['ssh_port']))
-    mysqldump_string = f"mysqldump -u {site_data['mysql_user']} -p{site_data['mysql_password']} " \
-        f"{site_data['mysql_db']} >/home/{site_data['ssh_username']}/tmp/database.sql"
-    mysqldump_string_star = f"mysqldump -u {site_data['mysql_user']} -p***** " \
-        f"{site_data['mysql_db']} >/home/{site_data['ssh_username']}/tmp/database.sql"
+    remote_dump_path = f"/home/{site_data['ssh_username']}/tmp/database.sql"
+    remote_pid_path = remote_dump_path + '.pid'
+    # The dump runs in the background on the server under timeout with its PID recorded, since hanging up ssh does
+    # not stop a command run without a pty.  The stale dump file is removed first, so a leftover mysqldump can only
+    # write to its own (unlinked) file and never into this run's dump.
+    dump_seconds = MYSQLDUMP_TIMEOUT
+    if g.deadline is not None:
+        dump_seconds = max(1, min(dump_seconds, int(get_remaining_seconds()) + 1))
+    mysqldump_string = f"rm -f {remote_dump_path} {remote_pid_path}; timeout {dump_seconds} mysqldump -u " \
+        f"{site_data['mysql_user']} -p{site_data['mysql_password']} {site_data['mysql_db']} >{remote_dump_path} & " \
+        f"echo $! >{remote_pid_path}; wait $!"
+    mysqldump_string_star = mysqldump_string.replace(f"-p{site_data['mysql_password']} ", '-p***** ')
     logging.debug(f"Executing this command over SSH: '{mysqldump_string_star}'")
-    msg = [stdin, stdout, stderr] = client.exec_command(mysqldump_string)
-    logging.debug(f'DB dump now under /tmp on server. Will do rsync to retrieve it')
     db_dump_filename = g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string + '/db/database.sql'
-    rsync_string = '/usr/bin/rsync --append --delete -aviz -e "ssh -p ' + str(site_data['ssh_port']) + '" "' + \
-        str(site_data['ssh_username']) + '@' + site_data['ssh_hostname'] + ':/home/' + site_data['ssh_username'] + \
-        '/tmp/database.sql' + '" "' + db_dump_filename + '"'
-    logging.debug(f'Executing: {rsync_string}')
     try:
-        exec_output = subprocess.check_output(rsync_string, stderr=subprocess.STDOUT, shell=True)
-    except subprocess.CalledProcessError as e:
-        rsync_err_string = 'rsync exited with error status ' + str(e.returncode) + ' and error: ' + str(e.output)
-        logging.error(rsync_err_string)
-        raise Exception(rsync_err_string)
+        with timed_span('ssh mysqldump', is_subprocess=True):
+            ssh(site_data, mysqldump_string, 'mysqldump', MYSQLDUMP_TIMEOUT)
+        logging.debug(f'DB dump now under /tmp on server. Will do rsync to retrieve it')
+        rsync_string = '/usr/bin/rsync --append --delete --info=progress2 -aviz -e "ssh -p ' + \
+            str(site_data['ssh_port']) + '" "' + str(site_data['ssh_username']) + '@' + site_data['ssh_hostname'] + \
+            ':' + remote_dump_path + '" "' + db_dump_filename + '"'
+        logging.debug(f'Executing: {rsync_string}')
+        try:
+            with timed_span('rsync database', is_subprocess=True):
+                run_rsync(rsync_string, f'database of site {site_name}')
+        except subprocess.CalledProcessError as e:
+            rsync_err_string = 'rsync exited with error status ' + str(e.returncode) + ' and error: ' + \
+                str(e.output)
+            logging.error(rsync_err_string)
+            raise Exception(rsync_err_string)
+    except Exception:
+        # Stop a mysqldump still running on the server (e.g. after a cancellation) and remove its files
+        logging.warning(f'Stopping database dump for site {site_name} on server and removing its files')
+        try:
+            ssh(site_data, f'kill $(cat {remote_pid_path} 2>/dev/null) 2>/dev/null; ' \
+                f'rm -f {remote_dump_path} {remote_pid_path}', 'Cleaning up database dump on server', cancellable=False)
+        except Exception:
+            pass
+        raise
     logging.debug(f'DB dump retrieved. Now delete on server.')
-    rm_string = f"rm /home/{site_data['ssh_username']}/tmp/database.sql"
+    rm_string = f"rm {remote_dump_path} {remote_pid_path}"
     logging.debug(f"Executing this command over SSH: '{rm_string}'")
-    msg = [stdin, stdout, stderr] = client.exec_command(rm_string)
+    ssh(site_data, rm_string, 'Deleting database dump on server')
     logging.debug(f'DB dump deleted on server.')
     db_dump_filename = g.backups_dir_path + '/' + site_name + '/' + g.datetime_start_string + '/db/database.sql'
     logging.info(f'Completed database dump for site {site_name} to {db_dump_filename}')
 
 
-def ssh(client, cmd):
-    out = []
-    msg = [stdin, stdout, stderr] = client.exec_command(cmd)
-    for item in msg:
+# Runs a site's backup pipeline while holding its site lease, under cProfile if --profile was specified.  A site whose
+# lease is held by another node is skipped, so each node moves on to whatever sites are still unclaimed.
+def run_site_pipeline(site_name, pipeline_function, *args):
+    global g
+    site_lease = Lease(site_name, 'site')
+    if not site_lease.acquire(heartbeat=True):
+        holder = read_lease(site_lease.path) or {}
+        logging.info(f"Skipping site {site_name} since node {holder.get('node')} is working on it")
+        return
+    g.site_leases[site_name] = site_lease
+    try:
+        return run_site_pipeline_profiled(site_name, pipeline_function, *args)
+    except LeaseLost:
+        logging.error(f'Stopped work on site {site_name} since its site lease was lost')
+    finally:
+        del g.site_leases[site_name]
+        site_lease.release()
+
+
+def run_site_pipeline_profiled(site_name, pipeline_function, *args):
+    global g
+    g.current_site = site_name
+    if g.profile_dir_path is None:
         try:
-            for line in item:
-                out.append(line)
-                logging.debug(f'Received line: {line}')
-        except: pass
-    return(list(out))
+            return pipeline_function(*args)
+        finally:
+            g.current_site = None
+    profiler = cProfile.Profile()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    profiler.enable()
+    try:
+        return pipeline_function(*args)
+    finally:
+        profiler.disable()
+        # A site visited again in the same run (maintenance pass of a --deadline run) gets its own profile file
+        previous = g.profile_sites.get(site_name, { 'wall': 0, 'cpu': 0 })
+        profile_suffix = '.maintenance.prof' if site_name in g.profile_sites else '.prof'
+        profiler.dump_stats(g.profile_dir_path + '/' + site_name + profile_suffix)
+        g.profile_sites[site_name] = { 'wall': previous['wall'] + time.perf_counter() - wall_start,
+                                       'cpu': previous['cpu'] + time.process_time() - cpu_start }
+        g.current_site = None
+
+
+# Times a block of work and, when profiling, accumulates its wall time per site under the given label.  Spans marked
+# is_subprocess (external commands and SSH round trips) are reported separately from Python CPU time.
+@contextlib.contextmanager
+def timed_span(label, is_subprocess=False):
+    global g
+    if g.profile_spans is None:
+        yield
+        return
+    span_start = time.perf_counter()
+    try:
+        yield
+    finally:
+        site_spans = g.profile_spans.setdefault(g.current_site or '(run)', {})
+        span = site_spans.setdefault(label, { 'count': 0, 'wall': 0.0, 'is_subprocess': is_subprocess })
+        span['count'] += 1
+        span['wall'] += time.perf_counter() - span_start
+
+
+def write_profile_summary():
+    global g
+    if g.profile_dir_path is None:
+        return
+    summary_path = g.profile_dir_path + '/summary.txt'
+    with open(summary_path, 'w') as summary_file:
+        summary_file.write(f'Profile of sg_backup run started {g.datetime_start_string}\n\n')
+        summary_file.write(f"{'Site':30} {'Wall s':>10} {'Python CPU s':>13} {'Subprocess wall s':>18}\n")
+        for site_name in g.profile_sites:
+            site_spans = g.profile_spans.get(site_name, {})
+            subprocess_wall = sum(x['wall'] for x in site_spans.values() if x['is_subprocess'])
+            summary_file.write(f"{site_name:30} {g.profile_sites[site_name]['wall']:10.2f} " \
+                f"{g.profile_sites[site_name]['cpu']:13.2f} {subprocess_wall:18.2f}\n")
+        summary_file.write(f"\n{'Site':30} {'Span':25} {'Kind':10} {'Count':>6} {'Wall s':>10}\n")
+        for site_name in g.profile_spans:
+            for label, span in sorted(g.profile_spans[site_name].items(), key=lambda x: -x[1]['wall']):
+                kind = 'subprocess' if span['is_subprocess'] else 'python'
+                summary_file.write(f"{site_name:30} {label:25} {kind:10} {span['count']:6} {span['wall']:10.2f}\n")
+        # Sites visited again by the maintenance pass also have a .maintenance.prof file
+        profile_paths = [ g.profile_dir_path + '/' + x + y for x in g.profile_sites
+                          for y in ('.prof', '.maintenance.prof') if os.path.exists(g.profile_dir_path + '/' + x + y) ]
+        if profile_paths:
+            summary_file.write('\nMerged Python profile of all sites (top 40 by cumulative time)\n')
+            merged_stats = pstats.Stats(*profile_paths, stream=summary_file)
+            merged_stats.sort_stats('cumulative').print_stats(40)
+    logging.info(f'Wrote profile summary to {summary_path}')
 
 
 def except_hook(type,value,traceback):
     logging.error("Unhandled exception occured",exc_info=(type,value,traceback))
     # And because flow was interrupted, handled ERROR log entries will not be emailed to admin, so email
     # the thrown unhandled exception right here
-    error_string = g.string_stream.getvalue()
-    send_admin_email(f'sg_backup encountered errors:\n{error_string}')
+    send_admin_email(f'sg_backup encountered errors:\n{g.log_capture.render()}')
 
 
 def send_email(recipient, subject, body):